@@ -1,5 +1,6 @@
 from sklearn.decomposition import TruncatedSVD
 import numpy as np
+import os
 
 def vector_sum(v1, v2):
   sum_v = []
@@ -22,6 +23,25 @@ def accumulate_emb(data, embed_dict, word_cnt_dict):
 
   return embed_dict, word_cnt_dict
 
+# Reads the binary output of elmo_revised: the words and a memory-mapped float32 matrix with
+# one row per word.
+def read_binary_emb(base):
+  with open(base + '.words') as f:
+    words = f.read().split('\n')[:-1]
+  vectors = np.memmap(base + '.f32', dtype=np.float32, mode='r')
+  return words, vectors.reshape(len(words), -1)
+
+def accumulate_binary_emb(words, vectors, batch_size):
+  vocab = {}
+  ids = np.array([vocab.setdefault(w, len(vocab)) for w in words], dtype=np.int64)
+  sums = np.zeros((len(vocab), vectors.shape[1]), dtype=np.float64)
+  for i in range(0, len(words), batch_size):
+    np.add.at(sums, ids[i:i+batch_size], vectors[i:i+batch_size])
+  counts = np.bincount(ids, minlength=len(vocab))
+  embed_dict = dict(zip(vocab, sums / counts[:, None]))
+  word_cnt_dict = dict(zip(vocab, counts.tolist()))
+  return embed_dict, word_cnt_dict
+
 def divide(l, a):
   for i in range(len(l)):
     l[i] /= a
@@ -32,6 +52,19 @@ def average(embed_dict, word_cnt_dict):
     embed_dict[w] = divide(embed_dict[w], word_cnt_dict[w])
   return embed_dict
 
+def reduce_emb(embed_dict, n_components):
+  X = []
+  for w in embed_dict:
+    X.append(embed_dict[w])
+
+  svd = TruncatedSVD(n_components=n_components, n_iter=100, random_state=42)
+  X = svd.fit_transform(X)
+
+  reduce_dict = {}
+  for emb, w in zip(X, embed_dict):
+    reduce_dict[w] = emb 
+  return reduce_dict
+
 def save_emb_to_file(embed_dict, fname):
   with open(fname,'w') as fil:
     for w in embed_dict:
@@ -46,36 +79,34 @@ if __name__ == "__main__":
   embed_dict = {}
   word_cnt_dict = {}
 
-  bno = 0
-  with open("new-elmo_embed_nr-10000_bsiz-100.txt", 'r') as f:
-    data = []
-    for line in f:
-      data.append(line.split())
-      if len(data) == batch_size:
-        bno += 1
-        if bno % 10 == 0:
-          print("Processing batch ", bno)
-        embed_dict, word_cnt_dict = accumulate_emb(data, embed_dict, word_cnt_dict)
-        data = []
-  f.close()
-  print("Done reading file")
-  embed_dict = average(embed_dict, word_cnt_dict)
+  emb_file = "new-elmo_embed_nr-10000_bsiz-100"
+  if os.path.exists(emb_file + ".f32"):
+    words, vectors = read_binary_emb(emb_file)
+    print("Read", len(words), "words")
+    embed_dict, word_cnt_dict = accumulate_binary_emb(words, vectors, 100 * batch_size)
+  else:
+    bno = 0
+    with open(emb_file + ".txt", 'r') as f:
+      data = []
+      for line in f:
+        data.append(line.split())
+        if len(data) == batch_size:
+          bno += 1
+          if bno % 10 == 0:
+            print("Processing batch ", bno)
+          embed_dict, word_cnt_dict = accumulate_emb(data, embed_dict, word_cnt_dict)
+          data = []
+    f.close()
+    print("Done reading file")
+    embed_dict = average(embed_dict, word_cnt_dict)
   print("Done averaging embeddings")
   save_emb_to_file(embed_dict, "elmo_embedding_news1000.txt")
   print("Done saving embeddings to file")
   print("vocab size: ", len(word_cnt_dict))
   
   print("Doing SVD")
-  X = []
-  for w in embed_dict:
-    X.append(embed_dict[w])
-
-  svd = TruncatedSVD(n_components=300, n_iter=100, random_state=42)
-  X = svd.fit_transform(X)
+  reduce_dict = reduce_emb(embed_dict, 300)
   print("Done dimension reduction") 
   
-  reduce_dict = {}
-  for emb, w in zip(X, embed_dict):
-    reduce_dict[w] = emb 
   save_emb_to_file(reduce_dict, "elmo_10000_dim300.txt")
   print("Reduced embeddings saved to file")
\ No newline at end of file
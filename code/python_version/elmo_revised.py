@@ -5,24 +5,51 @@ import torch.nn as nn
 import torch
 from torch import FloatTensor,LongTensor,ByteTensor, Tensor
 import torch.nn.functional as f
-from collections import OrderedDict
+from collections import Counter, OrderedDict
 from allennlp.data.token_indexers.elmo_indexer import ELMoCharacterMapper
 from torch.autograd import Variable
-import nltk,os
+import nltk,os,time
+import json
+import hashlib
+import sqlite3
+import multiprocessing
+import threading
+from queue import Queue
+import shutil
 import numpy as np
 import argparse
 import pickle
 from allennlp.modules.elmo import Elmo
 #from nn_layer import EmbeddingLayer, Encoder
 from allennlp.commands.elmo import ElmoEmbedder
+from news_corpus import NewsCorpus
+from average_embed import reduce_emb, save_emb_to_file
 
-def get_sentences(nr):
+output_format = 'text'
+reduced_file = None
+svd_dim = 300
+queue_size = 4
+embedding_cache = None
+state_windows = 10
+options_file = 'options.json'
+weights_file = 'weights.hdf5'
+
+def load_news(nr):
+    corpus_path = 'pickles/all-the-news_'+str(nr)+'.corpus'
+    if os.path.isdir(corpus_path):
+        print("loading ", corpus_path)
+        corpus = NewsCorpus(corpus_path)
+        return len(corpus), ((corpus.head(i), corpus.desc(i)) for i in range(len(corpus)))
     print("loading ", 'pickles/all-the-news_'+str(nr)+'.pickle')
     [heads, desc, _] = pickle.load(open('pickles/all-the-news_'+str(nr)+'.pickle', 'rb'))
-    print(len(heads), " news is loaded!")
+    return len(heads), zip(heads, desc)
+
+def get_sentences(nr):
+    num_news, news = load_news(nr)
+    print(num_news, " news is loaded!")
     
     sentences = []
-    for h, d in zip(heads, desc):
+    for h, d in news:
       sentences.append(h[0])
       cnt = 0
       for l in d:
@@ -49,13 +76,105 @@ def get_batches(data, batch_size):
             batched_data[len(batched_data) - 1].append(data[i])
     return batched_data
 
+# Sorts the sentences (given by their indices) by length so that a batch only holds sentences of
+# about the same length and little padding is needed. A batch has batch_size sentences, or with
+# max_tokens as many as fit in max_tokens tokens including the padding.
+def get_length_batches(data, idx, batch_size, max_tokens=None):
+    batched_data = []
+    for i in sorted(idx, key=lambda i: len(data[i])):
+        if not batched_data:
+            batched_data.append([i])
+        elif max_tokens is None and len(batched_data[-1]) < batch_size:
+            batched_data[-1].append(i)
+        elif max_tokens is not None and (len(batched_data[-1]) + 1) * len(data[i]) <= max_tokens:
+            batched_data[-1].append(i)
+        else:
+            batched_data.append([i])
+    return batched_data
+
+# Yields the windows of sentence indices that are embedded and written together, each with the
+# index of the first sentence after it. Without window a window is one batch in corpus order,
+# otherwise batch_window batches the sentences of a window by length. The output of a window is
+# written in corpus order, so a window has to fit in memory with its embeddings.
+def get_windows(data, batch_size, window=None):
+    if window is None:
+        for batch in get_batches(list(range(len(data))), batch_size):
+            yield batch[-1] + 1, batch
+        return
+    for start in range(0, len(data), window):
+        end = min(start + window, len(data))
+        yield end, list(range(start, end))
+
+def batch_window(data, idx, batch_size, window=None, max_tokens=None):
+    idx = [i for i in idx if len(data[i]) > 0]
+    if not idx:
+        return []
+    if window is None:
+        return [idx]
+    return get_length_batches(data, idx, batch_size, max_tokens)
+
+# Coverage scheduling: average_embed only needs some contexts of every word, so with
+# max_contexts a sentence is skipped once all its words have been seen max_contexts times in
+# the sentences kept before it. Every word then keeps at least min(max_contexts, its frequency)
+# contexts, while most sentences made of frequent words are never embedded.
+def schedule_sentences(sl, max_contexts):
+    counts = Counter()
+    total = Counter()
+    selected = []
+    for s in sl:
+        total.update(s)
+        if any(counts[w] < max_contexts for w in s):
+            selected.append(s)
+            counts.update(s)
+    saturated = sum(1 for w in counts if counts[w] >= max_contexts)
+    print("\tKept {0} of {1} sentences ({2} of {3} tokens), {4} of {5} word types reached {6} contexts and the others kept all of theirs".format(
+        len(selected), len(sl), sum(counts.values()), sum(total.values()), saturated, len(total), max_contexts))
+    kept = [counts[w] / total[w] for w in total]
+    print("\tA word type keeps {0:.1%} of its contexts on average, {1:.1f} contexts instead of {2:.1f}".format(
+        sum(kept) / max(len(kept), 1), sum(counts.values()) / max(len(counts), 1), sum(total.values()) / max(len(total), 1)))
+    return selected
+
+def padded_tokens(data, batches):
+    return sum(len(b) * max(len(data[i]) for i in b) for b in batches)
+
+# The character ids of every word are computed once: char_rows maps a word to its row in
+# char_ids. Row 0 is all zeros, so a batch is built by filling a preallocated array of row
+# numbers (0 where a sentence is shorter than maxl) and gathering the rows from char_ids. Like
+# with batch_to_ids, ELMo masks these padding positions, so the vectors of a sentence do not
+# depend on the length of the other sentences of its batch.
+char_rows = {}
+char_ids = np.zeros((1, ELMoCharacterMapper.max_word_length), dtype=np.int64)
+
+def grow_rows(arr, size):
+    if size <= len(arr):
+        return arr
+    grown = np.zeros((max(size, 2 * len(arr)),) + arr.shape[1:], dtype=arr.dtype)
+    grown[:len(arr)] = arr
+    return grown
+
+def word_char_rows(words):
+    global char_ids
+    new = [w for w in dict.fromkeys(words) if w not in char_rows]
+    if new:
+        char_ids = grow_rows(char_ids, 1 + len(char_rows) + len(new))
+        char_ids[1 + len(char_rows):1 + len(char_rows) + len(new)] = [ELMoCharacterMapper.convert_word_to_char_ids(w) for w in new]
+        for w in new:
+            char_rows[w] = 1 + len(char_rows)
+    return [char_rows[w] for w in words]
+
 def batch_sentence_mapper(batch, maxl):
-    return Variable(LongTensor([elmo_sent_mapper(sent,maxl) for sent in batch]))
+    lengths = np.array([len(sent) for sent in batch])
+    rows = np.zeros((len(batch), maxl), dtype=np.int64)
+    rows[np.arange(maxl) < lengths[:, None]] = word_char_rows([w for sent in batch for w in sent])
+    return Variable(torch.from_numpy(char_ids[rows]))
     # return batch_to_ids(batch)
 
 def store_batch_embeddings(sl, emb_red, num_rec, batch_size, max_sent_len):
+    if output_format == 'binary':
+        return store_binary_embeddings(sl, emb_red)
+    if output_format == 'average':
+        return accumulate_batch_embeddings(sl, emb_red)
     num_sent = len(sl)
-    emb_red = emb_red.data.numpy()
     count = 0
     #print(sum([len(s) for s in sl] ))
     with open(embedding_file,'a+') as fil:
@@ -66,38 +185,432 @@ def store_batch_embeddings(sl, emb_red, num_rec, batch_size, max_sent_len):
                 count+=1
     return count
 
-def get_elmo_embeddings(sl, num_rec, batch_size):
-    if os.path.exists(embedding_file):
-        print(embedding_file," already exists. Do you still want to proceed?")
-        x = input("(y/n) ")
-        if x=='y':
-            print("Continuing..")
-        else:
+# Binary output: the words go to <embedding_file>.words, one per line, and their vectors to
+# <embedding_file>.f32 as rows of float32 in the same order. All vectors of a call are written
+# as one block, the file can be read back with np.memmap (see average_embed.read_binary_emb).
+def store_binary_embeddings(sl, emb_red):
+    words = [w for s in sl for w in s]
+    if not words:
+        return 0
+    with open(embedding_file + '.words', 'a') as fil:
+        fil.write(''.join(w + '\n' for w in words))
+    with open(embedding_file + '.f32', 'ab') as fil:
+        fil.write(np.concatenate([e[:len(s)] for s, e in zip(sl, emb_red)]).astype(np.float32).tobytes())
+    return len(words)
+
+# Online averaging: with output_format = 'average' no token vector is written. The vectors of
+# every batch are added to a float32 sum per word (word_sums, one row per entry of word_ids) and
+# the words are counted, at the end only the averaged table is written to embedding_file, and
+# its SVD reduction to svd_dim dimensions to reduced_file, in the format of average_embed.
+word_ids = {}
+word_sums = np.zeros((0, 0), dtype=np.float32)
+word_counts = np.zeros(0, dtype=np.int64)
+
+def accumulate_batch_embeddings(sl, emb_red):
+    global word_sums, word_counts
+    words = [w for s in sl for w in s]
+    if not words:
+        return 0
+    ids = np.array([word_ids.setdefault(w, len(word_ids)) for w in words], dtype=np.int64)
+    vectors = np.concatenate([e[:len(s)] for s, e in zip(sl, emb_red)])
+    if not len(word_sums):
+        word_sums = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+    word_sums = grow_rows(word_sums, len(word_ids))
+    word_counts = grow_rows(word_counts, len(word_ids))
+    np.add.at(word_sums, ids, vectors)
+    word_counts[:len(word_ids)] += np.bincount(ids, minlength=len(word_ids))
+    return len(words)
+
+def save_average_embeddings():
+    n = len(word_ids)
+    embed_dict = dict(zip(word_ids, word_sums[:n] / word_counts[:n, None]))
+    save_emb_to_file(embed_dict, embedding_file)
+    print("Saved the average embeddings of {0} words to {1}".format(n, embedding_file))
+    if reduced_file is not None and n > svd_dim:
+        save_emb_to_file(reduce_emb(embed_dict, svd_dim), reduced_file)
+        print("Saved the embeddings reduced to {0} dimensions to {1}".format(svd_dim, reduced_file))
+
+def output_files():
+    if output_format == 'binary':
+        return [embedding_file + '.words', embedding_file + '.f32']
+    return [embedding_file]
+
+# Resuming: after every window (or batch) the number of sentences done, the sizes of the output
+# files and the counters are written to <embedding_file>.manifest.json. In 'average' mode the
+# per-word sums go to <embedding_file>.state.npz, which holds 1024 floats per word, so there the
+# sums and the manifest are only saved every state_windows windows and after the last one. A
+# rerun with the same settings truncates the output files to the recorded sizes, which drops a
+# partly written batch, and continues after the last recorded window. The manifest is marked
+# complete once the output is finished, and only then the sums are removed.
+def manifest_file():
+    return embedding_file + '.manifest.json'
+
+def state_file():
+    return embedding_file + '.state.npz'
+
+def read_manifest():
+    if not os.path.exists(manifest_file()):
+        return None
+    with open(manifest_file()) as f:
+        return json.load(f)
+
+def write_manifest(manifest):
+    manifest['sizes'] = dict((f, os.path.getsize(f)) for f in output_files() if os.path.exists(f))
+    tmp = manifest_file() + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, manifest_file())
+
+def truncate_outputs(sizes):
+    for f in output_files():
+        if os.path.exists(f):
+            with open(f, 'r+b') as fil:
+                fil.truncate(sizes.get(f, 0))
+
+def save_average_state():
+    n = len(word_ids)
+    tmp = state_file() + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, words=np.array(list(word_ids), dtype=str), sums=word_sums[:n], counts=word_counts[:n])
+    os.replace(tmp, state_file())
+
+def clear_average_state():
+    global word_sums, word_counts
+    word_ids.clear()
+    word_sums = np.zeros((0, 0), dtype=np.float32)
+    word_counts = np.zeros(0, dtype=np.int64)
+
+def load_average_state():
+    global word_sums, word_counts
+    clear_average_state()
+    if os.path.exists(state_file()):
+        state = np.load(state_file())
+        word_ids.update((w, i) for i, w in enumerate(state['words'].tolist()))
+        word_sums, word_counts = state['sums'], state['counts']
+
+def remove_progress_files():
+    for f in [manifest_file(), state_file()]:
+        if os.path.exists(f):
+            os.remove(f)
+
+def run_settings(sl, batch_size, window, max_tokens):
+    return dict(sentences=len(sl), tokens=sum(len(s) for s in sl), batch_size=batch_size, window=window,
+                max_tokens=max_tokens, output_format=output_format)
+
+def new_manifest(settings):
+    return dict(settings=settings, done=0, sizes={}, complete=False, stats=dict((k, 0) for k in STATS))
+
+# Sentence cache: a sentence is embedded once per window however often it occurs, and with
+# embedding_cache set its vectors are kept in that SQLite file, keyed by a hash of the model
+# files and its tokens, so that later windows and later runs with the same model read them
+# instead of running ELMo again. The LSTM states are reset before every batch and the padding
+# is masked, so a sentence gets the same vectors in any batch and the cached vectors are the
+# ones it would get. The mapping thread looks up the cache ahead of the writer, so a sentence
+# that repeats in the next window can be embedded twice; the vectors stored first are kept.
+def model_identity():
+    h = hashlib.sha1()
+    for path in [options_file, weights_file]:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b''):
+                h.update(block)
+    return h.hexdigest()
+
+def sentence_key(sent, model=''):
+    return hashlib.sha1((model + '\n' + ' '.join(sent)).encode('utf-8')).hexdigest()
+
+def open_embedding_cache(path):
+    if path is None:
+        return None
+    conn = sqlite3.connect(path, timeout=60) # the workers share the cache
+    conn.execute('CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, value BLOB)')
+    return conn
+
+def lookup_embedding_cache(conn, lengths, batch=500):
+    found = {}
+    if conn is None:
+        return found
+    keys = list(lengths)
+    for i in range(0, len(keys), batch):
+        part = keys[i:i+batch]
+        found.update(conn.execute('SELECT key, value FROM vectors WHERE key IN (%s)' % ','.join('?'*len(part)), part))
+    return dict((k, np.frombuffer(v, dtype=np.float32).reshape(lengths[k], -1)) for k, v in found.items())
+
+def store_embedding_cache(conn, vectors):
+    if conn is None:
+        return
+    conn.executemany('INSERT OR IGNORE INTO vectors VALUES (?, ?)', [(k, v.astype(np.float32).tobytes()) for k, v in vectors.items()])
+    conn.commit()
+
+# The windows are embedded in a pipeline of three stages connected by queues of at most
+# queue_size batches: a thread maps the batches to character ids, the forward pass runs in the
+# calling thread and a second thread converts the embeddings, writes a window once all its
+# batches are done and records it in the manifest. The time every stage spends waiting on its
+# queues is counted, forward_wait is the time the model sat idle waiting for input.
+STALLS = ['map_stall', 'forward_wait', 'forward_stall', 'write_wait']
+STATS = ['batches', 'words', 'padded', 'tokens', 'corpus_padding', 'embedded', 'duplicates', 'cached', 'map_time', 'forward_time'] + STALLS
+
+def timed_put(q, item, stats, key):
+    t = time.time()
+    q.put(item)
+    stats[key] += time.time() - t
+
+def timed_get(q, stats, key):
+    t = time.time()
+    item = q.get()
+    stats[key] += time.time() - t
+    if isinstance(item, Exception):
+        raise item
+    return item
+
+def map_stage(sl, windows, done, out, stats, batch_size, window, max_tokens):
+    try:
+        conn = open_embedding_cache(embedding_cache)
+        model = model_identity() if conn is not None else ''
+        for end, idx in windows:
+            if end <= done:
+                continue
+            keys = dict((i, sentence_key(sl[i], model)) for i in idx if len(sl[i]) > 0)
+            cached = lookup_embedding_cache(conn, dict((keys[i], len(sl[i])) for i in keys))
+            first = {}
+            for i in keys:
+                if keys[i] not in cached:
+                    first.setdefault(keys[i], i)
+            embed = sorted(first.values())
+            stats['corpus_padding'] += padded_tokens(sl, get_batches(embed, batch_size)) - sum(len(sl[i]) for i in embed)
+            for batch in batch_window(sl, embed, batch_size, window, max_tokens):
+                max_sent_len = max([len(sl[i]) for i in batch])
+                t = time.time()
+                mapped_sentences = batch_sentence_mapper([sl[i] for i in batch], max_sent_len)
+                stats['map_time'] += time.time() - t
+                timed_put(out, ('batch', batch, max_sent_len, mapped_sentences), stats, 'map_stall')
+            timed_put(out, ('window', end, keys, cached), stats, 'map_stall')
+        out.put(None)
+    except Exception as e:
+        out.put(e)
+
+def write_stage(sl, manifest, inp, stats, errors):
+    conn = None
+    fresh = {}
+    windows = 0
+    while True:
+        item = timed_get(inp, stats, 'write_wait')
+        if item is None:
             return
-    elmo_embedder = Elmo('options.json', 'weights.hdf5', 1)
-    batched_data = get_batches(sl, batch_size)
-    print("\t{0} sentences in {1} records and generated {2} batches each of {3} sentences".format(len(sl),num_rec,len(batched_data),batch_size))
-    bno = 0
-    wc  = 0
-    for batch in batched_data:
-        max_sent_len = max([len(s) for s in batch])
-        mapped_sentences = batch_sentence_mapper(batch, max_sent_len)
-        act = elmo_embedder(mapped_sentences)['elmo_representations']
-        emb_red = act[0]
-        cnt = store_batch_embeddings(batch, emb_red, num_rec,batch_size, max_sent_len)
-        bno+=1
-        wc +=cnt
-        print("\t\tStored batch {0} [with {1} words]".format(bno,cnt))
-    print("Generated embeddings for data with {0} words".format(wc)) 
+        if errors:
+            continue
+        try:
+            if conn is None:
+                conn = open_embedding_cache(embedding_cache)
+            if item[0] == 'batch':
+                _, batch, max_sent_len, act = item
+                for i, emb in zip(batch, act.data.numpy()):
+                    fresh[i] = emb[:len(sl[i])]
+                stats['batches'] += 1
+                stats['padded'] += len(batch) * max_sent_len
+                stats['tokens'] += sum(len(sl[i]) for i in batch)
+                continue
+            _, end, keys, cached = item
+            new = dict((keys[i], emb) for i, emb in fresh.items())
+            store_embedding_cache(conn, new)
+            vectors = dict(cached, **new)
+            order = sorted(keys)
+            cnt = store_batch_embeddings([sl[i] for i in order], [vectors[keys[i]] for i in order], None, None, None)
+            stats['words'] += cnt
+            stats['embedded'] += len(fresh)
+            stats['cached'] += sum(1 for i in order if keys[i] in cached)
+            stats['duplicates'] += sum(1 for i in order if keys[i] not in cached) - len(fresh)
+            fresh = {}
+            print("\t\tStored batch {0} [with {1} words]".format(stats['batches'],cnt))
+            windows += 1
+            if output_format == 'average' and windows % state_windows and end < len(sl):
+                continue
+            if output_format == 'average':
+                save_average_state()
+            manifest['done'] = end
+            write_manifest(manifest)
+        except Exception as e:
+            errors.append(e)
+
+def embed_sentences(sl, batch_size, window=None, max_tokens=None):
+    settings = run_settings(sl, batch_size, window, max_tokens)
+    manifest = read_manifest()
+    if manifest is None or manifest['settings'] != settings:
+        manifest = new_manifest(settings)
+    elif manifest['done']:
+        print("\tResuming after sentence {0} of {1}".format(manifest['done'], len(sl)))
+    truncate_outputs(manifest['sizes'])
+    if output_format == 'average' and manifest['done']:
+        load_average_state()
+    elif output_format == 'average':
+        clear_average_state()
+    stats = manifest['stats']
+    for key in STATS:
+        stats.setdefault(key, 0)
+    if manifest['done'] >= len(sl):
+        return stats
+    elmo_embedder = Elmo(options_file, weights_file, 1)
+    mapped, embedded, errors = Queue(queue_size), Queue(queue_size), []
+    mapper = threading.Thread(target=map_stage, args=(sl, get_windows(sl, batch_size, window), manifest['done'], mapped, stats, batch_size, window, max_tokens))
+    writer = threading.Thread(target=write_stage, args=(sl, manifest, embedded, stats, errors))
+    mapper.daemon = writer.daemon = True
+    mapper.start()
+    writer.start()
+    try:
+        while not errors:
+            item = timed_get(mapped, stats, 'forward_wait')
+            if item is None:
+                break
+            if item[0] == 'batch':
+                _, batch, max_sent_len, mapped_sentences = item
+                t = time.time()
+                with torch.no_grad():
+                    elmo_embedder._elmo_lstm._elmo_lstm.reset_states() # the bi-LSTM carries its state over from the last batch
+                    act = elmo_embedder(mapped_sentences)['elmo_representations']
+                stats['forward_time'] += time.time() - t
+                item = ('batch', batch, max_sent_len, act[0])
+            timed_put(embedded, item, stats, 'forward_stall')
+    finally:
+        embedded.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+    print("\tThe model waited {0:.1f}s for input and {1:.1f}s for the writer, mapping waited {2:.1f}s and writing {3:.1f}s".format(
+        stats['forward_wait'], stats['forward_stall'], stats['map_stall'], stats['write_wait']))
+    return stats
+
+# Multi-process inference: the sentences are cut into one contiguous shard per worker with
+# about the same number of tokens, at a multiple of window (of batch_size without window) so
+# that every worker embeds exactly the batches a single process would. Every worker is a fresh
+# process with its own Elmo and `threads` torch threads, and writes its shard to
+# <embedding_file>.part<k> (or returns its per-word sums in 'average' mode). The parts are
+# appended to the output in shard order. The LSTM states are reset before every batch, so the
+# result is the same as with a single process.
+def shard_bounds(sl, workers, unit=1):
+    ends = np.cumsum([len(s) for s in sl])
+    total = ends[-1] if len(sl) else 0
+    cuts = [int(np.searchsorted(ends, total * k / workers)) for k in range(1, workers)]
+    cuts = [min(int(round(c / unit)) * unit, len(sl)) for c in cuts]
+    return [0] + cuts + [len(sl)]
+
+def embed_shard(args):
+    global embedding_file, output_format, queue_size, embedding_cache, state_windows
+    sl, embedding_file, output_format, queue_size, embedding_cache, state_windows, threads, batch_size, window, max_tokens = args
+    torch.set_num_threads(threads)
+    stats = embed_sentences(sl, batch_size, window, max_tokens)
+    if output_format == 'average':
+        n = len(word_ids)
+        stats['average'] = (list(word_ids), word_sums[:n], word_counts[:n])
+    return stats
+
+def embed_in_processes(sl, batch_size, window, max_tokens, workers, threads=None):
+    global word_sums, word_counts
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    print("\tEmbedding in {0} processes with {1} torch threads each".format(workers, threads))
+    bounds = shard_bounds(sl, workers, window or batch_size)
+    parts = ['{0}.part{1}'.format(embedding_file, k) for k in range(workers)]
+    args = [(sl[bounds[k]:bounds[k+1]], parts[k], output_format, queue_size, embedding_cache, state_windows, threads, batch_size, window, max_tokens) for k in range(workers)]
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        results = pool.map(embed_shard, args)
+    stats = dict((k, sum(r[k] for r in results)) for k in STATS)
+    truncate_outputs({})
+    clear_average_state()
+    for part, r in zip(parts, results):
+        if output_format == 'average':
+            words, sums, counts = r['average']
+            if not words:
+                continue
+            if not len(word_sums):
+                word_sums = np.zeros((0, sums.shape[1]), dtype=np.float32)
+            ids = [word_ids.setdefault(w, len(word_ids)) for w in words]
+            word_sums = grow_rows(word_sums, len(word_ids))
+            word_counts = grow_rows(word_counts, len(word_ids))
+            word_sums[ids] += sums
+            word_counts[ids] += counts
+            continue
+        for suffix in ['.words', '.f32'] if output_format == 'binary' else ['']:
+            if os.path.exists(part + suffix):
+                with open(embedding_file + suffix, 'ab') as out, open(part + suffix, 'rb') as fil:
+                    shutil.copyfileobj(fil, out, 1 << 24)
+    return stats, parts
+
+# The parts are only removed once the merged output is complete, a rerun after a crash
+# during the merge finds the finished parts and merges them again.
+def remove_parts(parts):
+    global embedding_file
+    main_file = embedding_file
+    for part in parts:
+        embedding_file = part
+        for f in output_files():
+            if os.path.exists(f):
+                os.remove(f)
+        remove_progress_files()
+    embedding_file = main_file
+
+def get_elmo_embeddings(sl, num_rec, batch_size, window=None, max_tokens=None, workers=1, max_contexts=None):
+    if max_contexts is not None:
+        sl = schedule_sentences(sl, max_contexts)
+    manifest = read_manifest()
+    if manifest is None and any(os.path.exists(f) for f in output_files()):
+        print(embedding_file," already exists and was not generated by a resumable run, remove it to generate it again")
+        return
+    if manifest is not None and manifest['settings'] != run_settings(sl, batch_size, window, max_tokens):
+        print(embedding_file," was generated with other settings, remove it and ", manifest_file(), " to generate it again")
+        return
+    if manifest is not None and manifest['complete']:
+        print(embedding_file," is already complete")
+        return
+    corpus_order = get_batches(list(range(len(sl))), batch_size)
+    if window is None:
+        print("\t{0} sentences in {1} records and generated {2} batches each of {3} sentences".format(len(sl),num_rec,len(corpus_order),batch_size))
+    else:
+        print("\t{0} sentences in {1} records, batched by length in windows of {2} sentences".format(len(sl),num_rec,window))
+    parts = []
+    if workers > 1:
+        if manifest is None:
+            write_manifest(new_manifest(run_settings(sl, batch_size, window, max_tokens)))
+        stats, parts = embed_in_processes(sl, batch_size, window, max_tokens, workers)
+    else:
+        stats = embed_sentences(sl, batch_size, window, max_tokens)
+    wc = stats['words']
+    print("Generated embeddings for data with {0} words".format(wc))
+    print("{0} sentences embedded, {1} duplicates and {2} taken from the cache".format(stats['embedded'], stats['duplicates'], stats['cached']))
+    print("{0:.1f}s spent mapping characters, {1:.1f}s in the forward pass".format(stats['map_time'], stats['forward_time']))
+    if output_format == 'average':
+        save_average_embeddings()
+    manifest = new_manifest(run_settings(sl, batch_size, window, max_tokens))
+    manifest.update(done=len(sl), complete=True, stats=stats)
+    write_manifest(manifest)
+    if os.path.exists(state_file()): # only once the manifest is complete, a rerun needs the sums until then
+        os.remove(state_file())
+    remove_parts(parts)
+    pad_before = stats['corpus_padding'] # of the embedded sentences, the duplicates and cached ones need none
+    pad_after = stats['padded'] - stats['tokens']
+    if stats['embedded']:
+        print("{0} padding tokens instead of {1} in corpus order ({2:.1%} eliminated)".format(pad_after, pad_before, 1 - pad_after / max(pad_before, 1)))
     return 
 
 if __name__ == "__main__":
   num_records = 10000
   batch_size = 100
+  window = 2000 # sentences batched by length at once, None batches them in corpus order
+  max_tokens = None # tokens per batch including padding, None puts batch_size sentences in a batch
+  workers = 1 # ELMo processes, each uses cpu_count/workers torch threads
+  queue_size = 4 # batches queued between the mapping, forward and writing stages
+  state_windows = 10 # 'average' mode saves its per-word sums every this many windows, a rerun repeats at most as many
+  embedding_cache = 'pickles/elmo_cache.sqlite' # vectors of embedded sentences are kept here for reruns, None disables it
+  max_contexts = None # skip sentences whose words all have this many contexts already, None embeds every sentence
 
   print(" *********** Generating 1024 dimension embeddings for {0} news articles with batch size {1} *************".format(num_records,batch_size))
 
-  embedding_file = 'new-elmo_embed_nr-{0}_bsiz-{1}.txt'.format(num_records,batch_size)
+  output_format = 'binary' # 'text' writes a line with the word and its vector per token, 'binary' a words file and a float32 matrix, 'average' only the average vector per word
+  svd_dim = 300 # the 'average' table is also reduced to this many dimensions, None skips the SVD
+  embedding_file = 'new-elmo_embed_nr-{0}_bsiz-{1}'.format(num_records,batch_size)
+  if output_format == 'text':
+    embedding_file += '.txt'
+  if output_format == 'average':
+    embedding_file = 'elmo_embedding_news{0}.txt'.format(num_records)
+    if svd_dim is not None:
+      reduced_file = 'elmo_{0}_dim{1}.txt'.format(num_records,svd_dim)
 
   DIR = './pickles'
   nltk.download('punkt')
@@ -115,4 +628,4 @@ if __name__ == "__main__":
   #plt.hist(lengths, bins=np.arange(min(lengths), max(lengths)+1))
   #plt.plot()
 
-  get_elmo_embeddings(split_sent_list, num_records, batch_size)
+  get_elmo_embeddings(split_sent_list, num_records, batch_size, window, max_tokens, workers, max_contexts)
@@ -7,17 +7,36 @@
 
 
 #import statements
+import argparse
 import csv
+import hashlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import random
+import regex
+import shutil
+import socket
+from collections import Counter, deque
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import chain, islice
 import pandas as pd
 import numpy as np
 import nltk
 from nltk.tokenize import PunktSentenceTokenizer
 import pickle
+import sqlite3
+import time
+import zlib
 from nltk.stem import *
 from nltk import word_tokenize
 from nltk.stem.porter import *
 from nltk.stem import WordNetLemmatizer
 import nltk.text
+import news_corpus
 
 
 # # Relative locations of datasets
@@ -28,7 +47,32 @@ import nltk.text
 
 AP_NEWS_DIR = 'datasets/apnews'  
 ALL_NEWS_DIR = '~/.kaggle/datasets/snapcrack/all-the-news' #https://www.kaggle.com/snapcrack/all-the-news/data
+JSONL_DATA = 'datasets/signalmedia-1m.jsonl' #http://research.signalmedia.co/newsir16/signal-dataset.html
+ALL_NEWS_FILES = ['articles1.csv', 'articles2.csv', 'articles3.csv']
+DEDUP_THRESHOLD = None # drop articles whose estimated jaccard similarity to an earlier one is at least this, None keeps all
+DEDUP_NUM_PERM = 128 # number of minhash permutations
+DEDUP_SHINGLE = 3 # number of words per shingle
+STATS_LOG = 'pickles/ingest_stats.jsonl' # per-stage counters are appended here as json lines, None disables it
+STATS_INTERVAL = 30 # seconds between two snapshots written to STATS_LOG
+SHARD_SIZE = 10000 # number of articles per shard of a stored corpus
+SHARD_COMPRESSION = None # 'gz', 'bz2', 'xz' or 'zst' to write compressed shards, None writes memory-mappable ones
+INPUT_BUFFER = 1<<20 # bytes read from an input file at once
+UNIT_BYTES = 64*1024**2 # size of a work unit of an uncompressed jsonl file
+UNIT_ROWS = 10000 # size of a work unit of a csv or compressed jsonl file
+N_SENTENCES = 5 # sentences of a description used by vocabulary-embedding, also used by encode_news
+MAX_CONTENT_WORDS = 200 # content of jsonl articles is cut to this many words
 NUM_ROWS_EXTRACT = 5000
+SAMPLE_SEED = None # None extracts the first NUM_ROWS_EXTRACT rows, a seed extracts a uniform random sample of them
+NUM_WORKERS = 1 # number of tokenizer processes, 1 tokenizes in this process
+CHUNK_SIZE = 1000 # number of texts sent to a tokenizer process at once
+SENTENCE_BUDGET = None # stop tokenizing an article after this many sentences, None tokenizes all of it
+TOKEN_BUDGET = None # stop tokenizing an article once this many tokens are emitted, None tokenizes all of it
+WORD_MEMO_SIZE = 200000 # number of distinct words whose lemma/stem is memoized
+TOKEN_CACHE = 'pickles/token_cache.sqlite' # on-disk cache of tokenized texts, None disables it
+TOKEN_CACHE_MAX_BYTES = 4*1024**3 # least recently used texts are evicted above this size
+TOKENIZER = 'auto' # 'nltk', 'fast' or 'auto', which uses 'fast' when it agrees with 'nltk' on a sample of the input
+FAST_TOKENIZER_MAX_DIVERGENCE = 0.001 # 'auto' falls back to 'nltk' when more than this fraction of sampled texts come out different
+PARITY_SAMPLE = 200 # number of texts 'auto' compares both tokenizers on
 
 
 # Loading Punctuation for english language. You might need to dowload using nltk.download()
@@ -61,12 +105,105 @@ def remove_location_from_news(text):
 
 
 # __Description__:<br>
-# This method splits the article into meaningful sentences, lemmatizes the words and removes puntuation from the input text.<br>
+# These methods time the stages of the ingestion pipeline (read, dedup, tokenize, split, lemmatize, encode, store) and count the articles, tokens, bytes and errors that pass through them. Time is charged to the innermost active stage only, so a stage that pulls from another one does not include its time. Tokenizer processes send their split and lemmatize counters back with every chunk, the seconds of these stages are then summed over all processes. Every STATS_INTERVAL seconds the counters are appended to STATS_LOG as json lines and print_stage_summary prints them as a table at the end of a run.<br>
+
+# In[ ]:
+
+
+STAGES = ['read', 'dedup', 'tokenize', 'split', 'lemmatize', 'encode', 'store']
+stage_stats = {}
+active_stages = []
+last_charge = time.time()
+last_emit = time.time()
+is_worker = False
+
+def count_stage(stage, **counts):
+    st = stage_stats.setdefault(stage, dict(seconds=0.0, articles=0, tokens=0, bytes=0, errors=0))
+    for k, v in counts.items():
+        st[k] = st.get(k, 0) + v
+
+def charge_stage():
+    global last_charge
+    now = time.time()
+    if(active_stages):
+        count_stage(active_stages[-1], seconds=now-last_charge)
+    last_charge = now
+
+@contextmanager
+def stage(name):
+    charge_stage()
+    active_stages.append(name)
+    try:
+        yield
+    finally:
+        charge_stage()
+        active_stages.pop()
+
+def timed_stage(name, items, counter = None):
+    it = iter(items)
+    while True:
+        with stage(name):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        if(counter):
+            count_stage(name, **counter(item))
+        if(not is_worker and time.time()-last_emit > STATS_INTERVAL):
+            emit_stage_stats()
+        yield item
+
+def record_counts(record):
+    return dict(articles=1, bytes=len(record[0].encode('utf-8'))+len(record[1].encode('utf-8')))
+
+def chunk_counts(chunk):
+    return dict(articles=len(chunk))
+
+def reset_stage_stats():
+    global last_charge, last_emit
+    stage_stats.clear()
+    last_charge = last_emit = time.time()
+
+def stage_rates(name):
+    st = dict(stage_stats.get(name, {}))
+    secs = max(st.get('seconds', 0.0), 1e-9)
+    st.update(stage=name, articles_per_s=st.get('articles', 0)/secs, tokens_per_s=st.get('tokens', 0)/secs, bytes_per_s=st.get('bytes', 0)/secs)
+    return st
+
+def emit_stage_stats():
+    global last_emit
+    last_emit = time.time()
+    if(STATS_LOG is None):
+        return
+    with open(STATS_LOG, 'a') as f:
+        for name in STAGES:
+            if(name in stage_stats):
+                f.write(json.dumps(dict(stage_rates(name), time=last_emit))+'\n')
+
+def print_stage_summary():
+    emit_stage_stats()
+    print('{0:<10}{1:>10}{2:>10}{3:>12}{4:>12}{5:>12}{6:>10}{7:>8}'.format('stage', 'seconds', 'articles', 'articles/s', 'tokens', 'tokens/s', 'MB/s', 'errors'))
+    for name in STAGES:
+        if(name in stage_stats):
+            st = stage_rates(name)
+            print('{0:<10}{1:>10.1f}{2:>10}{3:>12.1f}{4:>12}{5:>12.1f}{6:>10.2f}{7:>8}'.format(name, st['seconds'], st['articles'], st['articles_per_s'], st['tokens'], st['tokens_per_s'], st['bytes_per_s']/1e6, st['errors']))
+
+
+# __Description__:<br>
+# This method splits the article into meaningful sentences, lemmatizes the words and removes puntuation from the input text. Lemmas and stems are memoized per distinct word (up to WORD_MEMO_SIZE words), since most tokens in news text are repeats of a few frequent words.<br>
 # __Input__ :<br>
 # >text: News Article Content or title<br>
 # use_lemmatizer: Whether to use lemmatizer or not<br>
 # use_stemmer : Whether to use lemmatizer or not<br>
-# interval: Number of rows(interval) to print status of processing
+# interval: Number of rows(interval) to print status of processing<br>
+# remove_location: Whether to remove the location from the beginning of the text<br>
+# max_sentences: Stop after this many sentences (None for no limit)<br>
+# max_tokens: Stop once this many tokens are emitted (None for no limit)<br>
+# tokenizer: 'nltk' runs nltk.wordpunct_tokenize on every sentence, 'fast' scans the sentence spans of the article with one compiled regex ('auto' means 'nltk' here, see select_tokenizer)
+# 
+# wordpunct_tokenize splits on \\w+|[^\\w\\s]+ and the tokens that are not alphanumeric (punctuation, but also words with an underscore or with combining marks, e.g. in NFD text) are dropped by the isalnum filter after lemmatizing. The fast tokenizer splits with the same pattern and the same regex engine, but drops those tokens before the lemmatizer, and it skips the second tokenization of the lemmatized sentence when stemming. Both give the same sentences unless the lemmatizer or stemmer turns an alphanumeric token into one that is not, or the other way round; check_tokenizer_parity counts how often that happens.
+# 
+# Sentences are split lazily, so the rest of an article is never looked at once the budget is used up. The split and lemmatize stages are timed once per article; with a TOKEN_BUDGET the sentences are split while they are tokenized, so their split time is counted as lemmatize time. vocabulary-embedding only keeps the first n_sentences = 5 sentences of each description, so a SENTENCE_BUDGET of 5 gives it the same input. Note that training keeps the last maxlend tokens of those sentences, so a TOKEN_BUDGET changes the training data.
 # 
 # __Output__:<br>
 # Processed News Article Content or title<br>
@@ -76,42 +213,299 @@ def remove_location_from_news(text):
 
 stemmer = PorterStemmer()
 lemmatizer = WordNetLemmatizer()
-def tokenize_text(text, use_lemmatizer = True, use_stemmer = False,interval=1000):
+def build_word_memo(maxsize = WORD_MEMO_SIZE):
+    global lemmatize, stem
+    lemmatize = lru_cache(maxsize)(lemmatizer.lemmatize)
+    stem = lru_cache(maxsize)(stemmer.stem)
+
+def word_memo_counts():
+    l, s = lemmatize.cache_info(), stem.cache_info()
+    return l.hits+s.hits, l.misses+s.misses
+
+build_word_memo()
+WORD_RE = regex.compile(r'\w+|[^\w\s]+') # nltk compiles wordpunct_tokenize with the regex engine, whose \w differs from re's
+def tokenize_sentence(sent, use_lemmatizer = True, use_stemmer = False):
+    if(use_lemmatizer):
+        sent = ' '.join([w_al for w_al in [lemmatize(w) for w in nltk.wordpunct_tokenize(sent)] if w_al.isalnum()])
+    if(use_stemmer):
+        sent = ' '.join([w_al for w_al in [stem(w) for w in nltk.wordpunct_tokenize(sent)] if w_al.isalnum()])
+    return sent
+
+def fast_tokenize_span(text, start, end, use_lemmatizer = True, use_stemmer = False):
+    if(not use_lemmatizer and not use_stemmer):
+        return text[start:end]
+    words = [w for w in WORD_RE.findall(text, start, end) if w.isalnum()]
+    if(use_lemmatizer):
+        words = [w_al for w_al in map(lemmatize, words) if w_al.isalnum()]
+    if(use_stemmer):
+        words = [w_al for w_al in map(stem, words) if w_al.isalnum()]
+    return ' '.join(words)
+
+def tokenize_text(text, use_lemmatizer = True, use_stemmer = False,interval=1000, remove_location = True, max_sentences = SENTENCE_BUDGET, max_tokens = TOKEN_BUDGET, tokenizer = TOKENIZER):
     global error_count, run_count
-    text = remove_location_from_news(text)
+    if(remove_location):
+        text = remove_location_from_news(text)
     run_count+=1
     if(run_count%interval==1):
         print(run_count)
     try:
         #print(text)
-        sent_l = english_sent_tokenizer.tokenize(text)
-        if(use_lemmatizer):
-            sent_l = [' '.join([w_al for w_al in [lemmatizer.lemmatize(w) for w in nltk.wordpunct_tokenize(sent)] if w_al.isalnum()]) for sent in sent_l]
-        if(use_stemmer):
-            sent_l = [' '.join([w_al for w_al in [stemmer.stem(w) for w in nltk.wordpunct_tokenize(sent)] if w_al.isalnum()]) for sent in sent_l]
+        sent_l = []
+        n_tokens = 0
+        with stage('split'):
+            spans = english_sent_tokenizer.span_tokenize(text)
+            if(max_tokens is None):
+                spans = list(islice(spans, max_sentences))
+        with stage('lemmatize'):
+            for start, end in spans:
+                if(len(sent_l) == max_sentences or (max_tokens is not None and n_tokens >= max_tokens)):
+                    break
+                if(tokenizer == 'fast'):
+                    sent = fast_tokenize_span(text, start, end, use_lemmatizer, use_stemmer)
+                else:
+                    sent = tokenize_sentence(text[start:end], use_lemmatizer, use_stemmer)
+                sent_l.append(sent)
+                n_tokens += len(sent.split())
+        count_stage('lemmatize', articles=1, tokens=n_tokens)
         #print(sent_l)
         return sent_l
     except Exception as e:
         print(e)
         print("Couldn't tokenize :")
         error_count+=1
+        count_stage('split', errors=1)
         #print((text))
         return [text]
 
 
+# __Description__:<br>
+# These methods compare the fast tokenizer with the nltk one. check_tokenizer_parity tokenizes a random sample of texts both ways and prints the differing sentences, select_tokenizer picks the tokenizer used when TOKENIZER is 'auto': 'fast' if at most max_divergence of the sampled texts differ, 'nltk' otherwise. When all texts are already in the token cache under one of the tokenizers, cached_tokenizer returns the choice of that earlier run and nothing is compared. The comparison does not count in the stage statistics.<br>
+# __Input__ :<br>
+# >texts: List of texts<br>
+# sample: Number of texts to compare (None compares all)<br>
+# seed: Seed of the sample<br>
+# examples: Number of differing sentences printed<br>
+# kwargs: Options passed to tokenize_text
+# 
+# __Output__:<br>
+# Fraction of the sampled texts that are tokenized differently<br>
+
+# In[ ]:
+
+
+def check_tokenizer_parity(texts, sample = PARITY_SAMPLE, seed = 0, examples = 5, **kwargs):
+    global error_count, run_count
+    counts = error_count, run_count
+    stats = dict((name, dict(st)) for name, st in stage_stats.items())
+    if(sample is not None):
+        texts = reservoir_sample(texts, sample, seed)
+    differ = 0
+    for text in texts:
+        slow = tokenize_text(text, tokenizer='nltk', **kwargs)
+        fast = tokenize_text(text, tokenizer='fast', **kwargs)
+        if(slow != fast):
+            differ += 1
+            for a, b in zip(slow, fast):
+                if(a != b and examples > 0):
+                    examples -= 1
+                    print('nltk:', a)
+                    print('fast:', b)
+    error_count, run_count = counts
+    stage_stats.clear()
+    stage_stats.update(stats) # the texts are tokenized for real later on
+    divergence = differ/max(len(texts), 1)
+    print('fast tokenizer: {0} of {1} texts differ from nltk ({2:.2%})'.format(differ, len(texts), divergence))
+    return divergence
+
+def cached_tokenizer(texts, cache = TOKEN_CACHE, batch = 500, **kwargs):
+    if(cache is None or not texts or not os.path.exists(cache)):
+        return None
+    conn = open_token_cache(cache)
+    try:
+        for tokenizer in ['fast', 'nltk']:
+            keys = list(set(token_cache_key(x, tokenizer=tokenizer, **kwargs) for x in texts))
+            found = 0
+            for i in range(0, len(keys), batch):
+                part = keys[i:i+batch]
+                found += conn.execute('SELECT COUNT(*) FROM tokens WHERE key IN (%s)' % ','.join('?'*len(part)), part).fetchone()[0]
+            if(found == len(keys)):
+                return tokenizer
+    finally:
+        conn.close()
+    return None
+
+def select_tokenizer(texts, max_divergence = FAST_TOKENIZER_MAX_DIVERGENCE, **kwargs):
+    tokenizer = cached_tokenizer(texts, **kwargs)
+    if(tokenizer is not None): # an earlier run already chose and tokenized them
+        return tokenizer
+    if(check_tokenizer_parity(texts, **kwargs) <= max_divergence):
+        return 'fast'
+    return 'nltk'
+
+
+# __Description__:<br>
+# These methods run tokenize_text in a pool of processes. Each worker loads the sentence tokenizer, lemmatizer and stemmer once when it starts and then tokenizes whole chunks of texts. The error, run, lemmatize/stem memo and stage counts of the workers are added back to the global counters.<br>
+# __Input__ :<br>
+# >chunks: Iterable of lists of texts<br>
+# workers: Number of processes, 1 tokenizes in this process<br>
+# max_pending: Number of chunks in flight at once (default 2 per worker)<br>
+# memo_size: Number of distinct words memoized by each worker
+# 
+# __Output__:<br>
+# Tokenized chunks, in the same order as the input<br>
+
+# In[ ]:
+
+
+def init_tokenizer_worker(memo_size = WORD_MEMO_SIZE):
+    global english_sent_tokenizer, lemmatizer, stemmer, error_count, run_count, is_worker
+    is_worker = True
+    english_sent_tokenizer = nltk.data.load('nltk:tokenizers/punkt/english.pickle')
+    lemmatizer = WordNetLemmatizer()
+    stemmer = PorterStemmer()
+    build_word_memo(memo_size)
+    error_count = 0
+    run_count = 0
+
+def tokenize_chunk(texts, kwargs):
+    runs, errors = run_count, error_count
+    hits, misses = word_memo_counts()
+    stage_stats.clear()
+    sent_ls = [tokenize_text(x, **kwargs) for x in texts]
+    new_hits, new_misses = word_memo_counts()
+    return sent_ls, (run_count-runs, error_count-errors, new_hits-hits, new_misses-misses, dict(stage_stats))
+
+memo_hits = 0
+memo_misses = 0
+def collect_chunk(result):
+    global error_count, run_count, memo_hits, memo_misses
+    sent_ls, (runs, errors, hits, misses, stats) = result.get()
+    for name, counts in stats.items():
+        count_stage(name, **counts)
+    run_count += runs
+    error_count += errors
+    memo_hits += hits
+    memo_misses += misses
+    return sent_ls
+
+def print_word_memo_stats():
+    hits, misses = word_memo_counts()
+    hits, misses = hits+memo_hits, misses+memo_misses
+    print('lemmatize/stem memo: {0} hits, {1} misses ({2:.1%} hit rate)'.format(hits, misses, hits/max(hits+misses, 1)))
+
+def tokenize_chunks(chunks, workers = 1, max_pending = None, memo_size = WORD_MEMO_SIZE, **kwargs):
+    if(workers <= 1):
+        for texts in chunks:
+            yield [tokenize_text(x, **kwargs) for x in texts]
+        return
+    max_pending = max_pending or 2*workers
+    with multiprocessing.Pool(workers, initializer=init_tokenizer_worker, initargs=(memo_size,)) as pool:
+        pending = deque()
+        for texts in chunks:
+            pending.append(pool.apply_async(tokenize_chunk, (list(texts), kwargs)))
+            if(len(pending) >= max_pending):
+                yield collect_chunk(pending.popleft())
+        while pending:
+            yield collect_chunk(pending.popleft())
+
+
+# __Description__:<br>
+# These methods keep tokenized texts in a SQLite file so that reruns only tokenize texts that were not seen before. Texts are keyed by a hash of the raw text and the tokenizer options. When the file grows above max_bytes the least recently used texts are evicted.<br>
+# __Input__ :<br>
+# >chunks: Iterable of lists of texts<br>
+# cache: Path of the cache file (None disables the cache)<br>
+# workers: Number of tokenizer processes<br>
+# kwargs: Options passed to tokenize_text
+# 
+# __Output__:<br>
+# Tokenized chunks, in the same order as the input<br>
+
+# In[ ]:
+
+
+def open_token_cache(path):
+    conn = sqlite3.connect(path, timeout=60) # several processes may share the cache
+    conn.execute('CREATE TABLE IF NOT EXISTS tokens (key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS tokens_used ON tokens (used)')
+    return conn
+
+def token_cache_key(text, use_lemmatizer = True, use_stemmer = False, remove_location = True, max_sentences = SENTENCE_BUDGET, max_tokens = TOKEN_BUDGET, tokenizer = TOKENIZER, **kwargs):
+    opts = '%d%d%d %s %s' % (use_lemmatizer, use_stemmer, remove_location, max_sentences, max_tokens)
+    if(tokenizer == 'fast'):
+        opts += ' fast'
+    return hashlib.sha1((opts+'\0'+text).encode('utf-8')).hexdigest()
+
+def lookup_token_cache(conn, keys, batch = 500):
+    found = {}
+    for i in range(0, len(keys), batch):
+        part = keys[i:i+batch]
+        marks = ','.join('?'*len(part))
+        found.update(conn.execute('SELECT key, value FROM tokens WHERE key IN (%s)' % marks, part))
+        conn.execute('UPDATE tokens SET used = ? WHERE key IN (%s)' % marks, [time.time()]+part)
+    return dict((k, pickle.loads(v)) for k, v in found.items())
+
+def store_token_cache(conn, keys, sent_ls):
+    now = time.time()
+    rows = []
+    for k, sent_l in zip(keys, sent_ls):
+        value = pickle.dumps(sent_l, pickle.HIGHEST_PROTOCOL)
+        rows.append((k, value, len(value), now))
+    conn.executemany('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)', rows)
+    conn.commit()
+
+def evict_token_cache(conn, max_bytes):
+    total = 0
+    for used, size in conn.execute('SELECT used, size FROM tokens ORDER BY used DESC'):
+        total += size
+        if(total > max_bytes):
+            conn.execute('DELETE FROM tokens WHERE used <= ?', (used,))
+            conn.commit()
+            print('Evicted tokenized texts older than', time.ctime(used), 'from the cache')
+            break
+
+def cached_tokenize_chunks(chunks, cache = TOKEN_CACHE, workers = 1, max_bytes = TOKEN_CACHE_MAX_BYTES, **kwargs):
+    if(cache is None):
+        yield from tokenize_chunks(chunks, workers, **kwargs)
+        return
+    conn = open_token_cache(cache)
+    pending = deque()
+    def misses():
+        for texts in chunks:
+            keys = [token_cache_key(x, **kwargs) for x in texts]
+            hits = lookup_token_cache(conn, keys)
+            missed = [i for i, k in enumerate(keys) if k not in hits]
+            pending.append((keys, hits, missed))
+            yield [texts[i] for i in missed]
+    try:
+        for sent_ls in tokenize_chunks(misses(), workers, **kwargs):
+            keys, hits, missed = pending.popleft()
+            store_token_cache(conn, [keys[i] for i in missed], sent_ls)
+            hits.update(zip((keys[i] for i in missed), sent_ls))
+            yield [hits[k] for k in keys]
+        evict_token_cache(conn, max_bytes)
+    finally:
+        conn.close()
+
+
 # __Description__:<br>
 # This method is a wrapper that preprocesses the title and content of the news dataframe.<br> 
 # __Input__ :<br>
-# News data frame with 'content' and 'title' columns<br> 
+# >df: News data frame with 'content' and 'title' columns<br>
+# workers: Number of tokenizer processes<br>
+# chunk_size: Number of texts per chunk sent to a process
+# 
 # __Output__:<br>
 # Processed News data frame with 'content' and 'title' columns<br>
 
 # In[26]:
 
 
-def parse_dataframe(df):
-    df['content']=df['content'].apply(lambda x : tokenize_text(x))
-    df['title']=df['title'].apply(lambda x : tokenize_text(x))
+def parse_dataframe(df, workers = NUM_WORKERS, chunk_size = CHUNK_SIZE):
+    for col in ['content', 'title']:
+        texts = df[col].tolist()
+        chunks = (texts[i:i+chunk_size] for i in range(0, len(texts), chunk_size))
+        sent_ls = [sent_l for chunk in cached_tokenize_chunks(chunks, TOKEN_CACHE, workers) for sent_l in chunk]
+        df[col] = pd.Series(sent_ls, index=df.index, dtype=object)
     return df
 
 
@@ -136,11 +530,324 @@ def tuple2pickle(df,nr):
     print('Extracting rows into ', 'pickles/all-the-news_'+nr+'.pickle')
 
 
+# __Description__:<br>
+# This method opens an input file as text, decompressing .gz, .bz2, .xz and .zst (needs the zstandard package) files on the fly in large blocks. If the file itself does not exist but a compressed copy of it does (e.g. articles1.csv.gz for articles1.csv), the compressed copy is read.<br>
+# __Input__ :<br>
+# >path: Path of the input file
+# 
+# __Output__:<br>
+# Text file object<br>
+
+# In[ ]:
+
+
+def open_input(path):
+    path = os.path.expanduser(path)
+    if(not os.path.exists(path)):
+        for ext in news_corpus.COMPRESSIONS:
+            if(os.path.exists(path+'.'+ext)):
+                path = path+'.'+ext
+                break
+    raw = news_corpus.open_compressed(path, 'rb')
+    return io.TextIOWrapper(io.BufferedReader(raw, INPUT_BUFFER), encoding='utf-8')
+
+def is_jsonl(path):
+    ext = path.rsplit('.', 1)[-1]
+    if(ext in news_corpus.COMPRESSIONS):
+        path = path[:-len(ext)-1]
+    return path.endswith('.jsonl')
+
+
+# __Description__:<br>
+# This method draws a uniform random sample of k items from an iterable in a single pass, keeping only the k sampled items in memory (reservoir sampling, Li's algorithm L, which skips ahead instead of drawing a random number per item). The sample is returned in input order, so the same seed always gives the same list.<br>
+# __Input__ :<br>
+# >items: Iterable to sample from<br>
+# k: Size of the sample<br>
+# seed: Seed of the random generator
+# 
+# __Output__:<br>
+# List of the sampled items (all items if there are fewer than k)<br>
+
+# In[ ]:
+
+
+def reservoir_sample(items, k, seed = None):
+    rng = random.Random(seed)
+    def u():
+        return rng.random() or 1e-300
+    it = enumerate(items)
+    reservoir = list(islice(it, k))
+    if(len(reservoir) == k and k > 0):
+        w = math.exp(math.log(u())/k)
+        while True:
+            skip = int(math.log(u())/math.log1p(-w)) if w < 1 else 0
+            item = next(islice(it, skip, skip+1), None)
+            if(item is None):
+                break
+            reservoir[rng.randrange(k)] = item
+            w *= math.exp(math.log(u())/k)
+    reservoir.sort(key=lambda x: x[0])
+    return [x for i, x in reservoir]
+
+
+# __Description__:<br>
+# These methods stream the signalmedia-1m jsonl file through truncation, tokenization and serialization without building a dataframe. Only one chunk per worker is held in memory at any time.<br>
+# __Input__ :<br>
+# >path: Path of the jsonl file<br>
+# rows: Number of articles to read (None reads all of them)<br>
+# max_words: Number of words the content is cut to<br>
+# seed: None reads the first rows articles, otherwise a random sample of rows articles (see reservoir_sample)
+# 
+# __Output__:<br>
+# read_jsonl yields (title, content) tuples, tokenize_records (and tokenize_record_chunks for records that are already chunked) yields chunks of (title, content) tuples with both tokenized<br>
+
+# In[ ]:
+
+
+def parse_jsonl_line(line, max_words = MAX_CONTENT_WORDS):
+    j = json.loads(line)
+    content = ' '.join(j['content'].split()[:max_words])
+    return j['title'], content
+
+def read_jsonl(path, rows = None, max_words = MAX_CONTENT_WORDS, seed = None):
+    with open_input(path) as infile:
+        lines = islice(infile, rows) if seed is None else reservoir_sample(infile, rows, seed)
+        for line in lines:
+            yield parse_jsonl_line(line, max_words)
+
+def chunk_records(records, chunk_size = CHUNK_SIZE):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if(len(chunk) == chunk_size):
+            yield chunk
+            chunk = []
+    if(chunk):
+        yield chunk
+
+def tokenize_records(records, workers = NUM_WORKERS, chunk_size = CHUNK_SIZE, cache = TOKEN_CACHE, **kwargs):
+    return tokenize_record_chunks(chunk_records(records, chunk_size), workers, cache, **kwargs)
+
+def tokenize_record_chunks(chunks, workers = NUM_WORKERS, cache = TOKEN_CACHE, **kwargs):
+    texts = ([t for t, c in chunk] + [c for t, c in chunk] for chunk in chunks)
+    for sent_ls in cached_tokenize_chunks(texts, cache, workers, **kwargs):
+        n = len(sent_ls)//2
+        yield list(zip(sent_ls[:n], sent_ls[n:]))
+
+
+# __Description__:<br>
+# This method drops near duplicate articles (wire stories reposted by several publications) before they are tokenized. Every article gets a MinHash signature of its word shingles, the signatures are split into LSH bands and an article is dropped when it shares a band with an earlier kept article and their estimated jaccard similarity is at least threshold. The dropped articles are written to report as json lines. To keep the memory per kept article small, the signatures are kept in one growing uint32 array and the bands are looked up by an integer hash. check_dedup makes sure that unrelated articles which only share a phrase are all kept.<br>
+# __Input__ :<br>
+# >records: Iterable of (title, content) tuples<br>
+# threshold: Similarity threshold (None disables deduplication)<br>
+# num_perm: Number of MinHash permutations<br>
+# report: Path of the report of dropped articles (None for no report)
+# 
+# __Output__:<br>
+# Generator of the kept (title, content) tuples<br>
+
+# In[ ]:
+
+
+def lsh_bands(threshold, num_perm):
+    # the band/row split whose S-curve (1/b)**(1/r) is closest to threshold
+    splits = [(b, num_perm//b) for b in range(1, num_perm+1)]
+    return min(splits, key=lambda br: abs((1.0/br[0])**(1.0/br[1]) - threshold))
+
+def minhash(text, a, b, shingle = DEDUP_SHINGLE):
+    words = text.lower().split()
+    shingles = set(' '.join(words[i:i+shingle]) for i in range(max(len(words)-shingle+1, 1)))
+    hv = np.array([zlib.crc32(sh.encode('utf-8')) for sh in shingles], dtype=np.uint64)
+    # multiply-add-shift: the high 32 bits of a*hv+b mod 2**64 are a 2-independent hash of the 32 bit hv
+    return ((np.outer(a, hv) + b[:, None]) >> np.uint64(32)).min(axis=1).astype(np.uint32)
+
+def dedup_records(records, threshold = DEDUP_THRESHOLD, num_perm = DEDUP_NUM_PERM, report = None):
+    if(threshold is None):
+        yield from records
+        return
+    rng = np.random.RandomState(1)
+    a = rng.randint(0, 1<<64, num_perm, dtype=np.uint64)
+    b = rng.randint(0, 1<<64, num_perm, dtype=np.uint64)
+    bands, rows = lsh_bands(threshold, num_perm)
+    mult = rng.randint(1, 1<<32, rows).astype(np.uint64) | np.uint64(1)
+    buckets = [{} for _ in range(bands)] # integer hash of a band -> row of the first kept article in sigs
+    sigs = np.zeros((1024, num_perm), dtype=np.uint32) # signatures of the kept articles, grown as needed
+    kept_ids = np.zeros(1024, dtype=np.int64) # input index of every kept article
+    n_kept = 0
+    dropped = 0
+    out = open(report, 'w') if report else None
+    try:
+        for i, (title, content) in enumerate(records):
+            sig = minhash(title+' '+content, a, b)
+            keys = (sig[:bands*rows].reshape(bands, rows).astype(np.uint64) * mult).sum(axis=1).tolist()
+            candidates = set(buckets[k][key] for k, key in enumerate(keys) if key in buckets[k])
+            best, sim = None, 0.0
+            for j in candidates:
+                s = float(np.mean(sigs[j] == sig))
+                if(s > sim):
+                    best, sim = j, s
+            if(sim >= threshold):
+                dropped += 1
+                if(out):
+                    out.write(json.dumps({'index': i, 'duplicate_of': int(kept_ids[best]), 'similarity': sim, 'title': title})+'\n')
+                continue
+            if(n_kept == len(sigs)):
+                sigs = np.concatenate([sigs, np.zeros_like(sigs)])
+                kept_ids = np.concatenate([kept_ids, np.zeros_like(kept_ids)])
+            sigs[n_kept] = sig
+            kept_ids[n_kept] = i
+            for k, key in enumerate(keys):
+                buckets[k].setdefault(key, n_kept)
+            n_kept += 1
+            yield title, content
+        print('Dropped', dropped, 'near duplicates of', dropped+n_kept, 'articles')
+    finally:
+        if(out):
+            out.close()
+
+def check_dedup(threshold = 0.8, n = 300, words = 200, shared = 'with of a', seed = 0):
+    rng = random.Random(seed)
+    vocab = ['w%d' % i for i in range(10000)]
+    records = [('', ' '.join(rng.choice(vocab) for _ in range(words))+' '+shared) for _ in range(n)]
+    dropped = n - sum(1 for _ in dedup_records(records, threshold))
+    assert dropped == 0, '%d unrelated articles sharing one shingle were dropped' % dropped
+    return dropped
+
+
+# __Description__:<br>
+# This method writes tokenized chunks as a sharded corpus (see news_corpus.py) that consumers can memory-map and read article by article with news_corpus.NewsCorpus. Like tuple2pickle, articles with an empty title are dropped.<br>
+# __Input__ :<br>
+# >chunks: Iterable of lists of (title, content) tuples<br>
+# path: Directory of the corpus<br>
+# shard_size: Number of articles per shard<br>
+# append: Whether to add the articles as new shards of an existing corpus<br>
+# source: Name of the input recorded with the new shards<br>
+# progress: Progress dictionary of ingest_records, its input position is recorded with every shard<br>
+# compress: Compression of the shards (see SHARD_COMPRESSION)
+# 
+# __Output__:<br>
+# Number of articles written<br>
+
+# In[ ]:
+
+
+def store_corpus(chunks, path, shard_size = SHARD_SIZE, append = False, source = None, progress = None, compress = SHARD_COMPRESSION):
+    def kept(chunk):
+        chunk = [(t, c) for t, c in chunk if len(t)>=1]
+        return [t for t, c in chunk], [c for t, c in chunk]
+    checkpoint = (lambda: progress['done']) if progress else None
+    with stage('store'):
+        count = news_corpus.write_corpus(path, (kept(chunk) for chunk in chunks), shard_size, append, source, checkpoint, compress)
+    count_stage('store', articles=count)
+    print('Extracting', count, 'rows into ', path)
+    return count
+
+
+# __Description__:<br>
+# This method reads the "all the news" csv files in chunks. Only the 'title' and 'content' columns are parsed and reading stops as soon as rows articles have been read.<br>
+# __Input__ :<br>
+# >rows: Number of rows to read (None reads all of them)<br>
+# chunksize: Number of rows per chunk<br>
+# seed: (read_all_news_records only) None reads the first rows articles, otherwise a random sample of rows articles of all three files
+# 
+# __Output__:<br>
+# Generator of data frames with 'content' and 'title' columns, read_all_news_records yields (title, content) tuples<br>
+
+# In[ ]:
+
+
+def read_all_news(rows = None, chunksize = CHUNK_SIZE):
+    for fname in ALL_NEWS_FILES:
+        with open_input(ALL_NEWS_DIR+'/'+fname) as f, pd.read_csv(f, usecols=['title','content'], chunksize=chunksize, keep_default_na=False) as reader:
+            for df in reader:
+                if(rows is not None):
+                    df = df.head(rows)
+                    rows -= len(df)
+                yield df
+                if(rows == 0):
+                    return
+
+def read_all_news_records(rows = None, chunksize = CHUNK_SIZE, seed = None):
+    if(seed is not None):
+        yield from reservoir_sample(read_all_news_records(None, chunksize), rows, seed)
+        return
+    for df in read_all_news(rows, chunksize):
+        yield from zip(df['title'], df['content'])
+
+
+# __Description__:<br>
+# This method chains the reading, deduplication and tokenization stages of an ingestion run and resets the error, run and stage counters. It also keeps track of how many input records are covered by the chunks handed out so far (progress['done']), which store_corpus records as a checkpoint with every shard. With TOKENIZER = 'auto' the tokenizer is chosen by select_tokenizer on the titles and contents of the first chunk.<br>
+# __Input__ :<br>
+# >records: Iterable of (title, content) tuples<br>
+# workers: Number of tokenizer processes<br>
+# report: Path of the report of dropped near duplicates<br>
+# skip: Number of input records to skip, e.g. the ones committed before a restart
+# 
+# __Output__:<br>
+# Generator of chunks of tokenized (title, content) tuples and the progress dictionary<br>
+
+# In[ ]:
+
+
+def ingest_records(records, workers = NUM_WORKERS, report = None, skip = 0):
+    global error_count, run_count
+    error_count = 0
+    run_count = 0
+    reset_stage_stats()
+    progress = dict(read=skip, done=skip)
+    pending = deque()
+    def counted(records):
+        for record in islice(records, skip, None):
+            progress['read'] += 1
+            yield record
+    def marked(chunks):
+        for chunk in chunks:
+            pending.append(progress['read'])
+            yield chunk
+    def tracked(chunks):
+        for chunk in chunks:
+            progress['done'] = pending.popleft()
+            yield chunk
+    records = timed_stage('read', counted(records), record_counts)
+    records = timed_stage('dedup', dedup_records(records, DEDUP_THRESHOLD, DEDUP_NUM_PERM, report), lambda record: dict(articles=1))
+    chunks = chunk_records(records)
+    tokenizer = TOKENIZER
+    if(tokenizer == 'auto'):
+        first = next(chunks, [])
+        tokenizer = select_tokenizer([x for record in first for x in record])
+        print('Using the', tokenizer, 'tokenizer')
+        chunks = chain([first], chunks)
+    chunks = tracked(tokenize_record_chunks(marked(chunks), workers, tokenizer=tokenizer))
+    return timed_stage('tokenize', chunks, chunk_counts), progress
+
+
+# __Description__:<br>
+# This method returns where an interrupted ingestion into a corpus has to continue. Shards are committed to the corpus index one by one together with the number of input records they cover, so after a crash or kill only the shard being written is lost. A complete corpus, or one that was being filled from another source, starts over.<br>
+# __Input__ :<br>
+# >path: Directory of the corpus<br>
+# source: Name of the input being ingested
+# 
+# __Output__:<br>
+# Whether to append to the corpus and the number of input records to skip<br>
+
+# In[ ]:
+
+
+def resume_point(path, source = None):
+    index = news_corpus.read_index(path)
+    if(not index['shards'] or index.get('complete', True) or index['shards'][-1].get('source') != source):
+        return False, 0
+    skip = index['shards'][-1].get('input_rows', 0)
+    print('Resuming', path, 'after', skip, 'input records')
+    return True, skip
+
+
 # __Description__:<br>
 # This method loads, cleans, preprocesses and returns the "all the news" dataset as a dataframe with 'content' and 'title' columns.<br> 
 # __Input__ :<br>
 # >partial: Whether to load partial data or complete data<br>
-# rows: Number of rows to be processed if partial is True
+# rows: Number of rows to be processed if partial is True<br>
+# seed: None takes the first rows articles, otherwise a random sample of rows articles stored as all-the-news_<rows>-seed<seed>
 # 
 # __Output__:<br>
 # Processed News data frame with 'content' and 'title' columns<br>
@@ -150,31 +857,320 @@ def tuple2pickle(df,nr):
 
 error_count = 0
 run_count = 0 
-def get_all_news_df(partial= True,rows = 5000):
-    global error_count, run_count
-    error_count = 0
-    run_count = 0 
-    df = pd.read_csv(ALL_NEWS_DIR+'/articles1.csv')
-    df = df.append(pd.read_csv(ALL_NEWS_DIR+'/articles2.csv'))
-    df = df.append(pd.read_csv(ALL_NEWS_DIR+'/articles3.csv'))
-    df2 = df[['title','content']]
-    if(partial):
-        df3 = parse_dataframe(df2.head(rows))
-        tuple2pickle(df3,str(rows))
-    else: 
-        df3 = parse_dataframe(df2)
-        tuple2pickle(df3,'all')
+def sample_name(rows, seed):
+    return str(rows) if seed is None else '%d-seed%d' % (rows, seed)
+
+def get_all_news_df(partial= True,rows = 5000, workers = NUM_WORKERS, seed = SAMPLE_SEED):
+    nr = sample_name(rows, seed) if partial else 'all'
+    stream_all_news(partial, rows, workers, seed)
+    corpus = news_corpus.NewsCorpus('pickles/all-the-news_'+nr+'.corpus')
+    df3 = pd.DataFrame(list(corpus), columns=['title','content'])
+    tuple2pickle(df3, nr)
     return df3
 
 
-# In[29]:
+# __Description__:<br>
+# This method tokenizes the "all the news" dataset chunk by chunk and streams it into the sharded corpus pickles/all-the-news_<rows>.corpus. Memory use does not grow with the size of the corpus, and a run that was interrupted continues after the last committed shard.<br> 
+# __Input__ :<br>
+# >partial: Whether to load partial data or complete data<br>
+# rows: Number of rows to be processed if partial is True<br>
+# seed: None takes the first rows articles, otherwise a random sample of rows articles
+# 
+# __Output__:<br>
+# Number of stored articles<br>
+
+# In[ ]:
+
+
+def stream_all_news(partial = True, rows = 5000, workers = NUM_WORKERS, seed = SAMPLE_SEED):
+    nr = sample_name(rows, seed) if partial else 'all'
+    path = 'pickles/all-the-news_'+nr+'.corpus'
+    append, skip = resume_point(path, ALL_NEWS_DIR)
+    records = read_all_news_records(rows, seed=seed) if partial else read_all_news_records(None)
+    chunks, progress = ingest_records(records, workers, 'pickles/all-the-news_'+nr+'.dedup.jsonl', skip)
+    count = store_corpus(chunks, path, append=append, source=ALL_NEWS_DIR, progress=progress)
+    print_stage_summary()
+    return count
+
+
+# __Description__:<br>
+# This method tokenizes and stores either dataset. The jsonl dataset is streamed straight from the file into the sharded corpus pickles/json_news_<rows>.corpus. Interrupted runs continue after the last committed shard.<br>
+# __Input__ :<br>
+# >rows: Number of rows to be processed<br>
+# PATH: ALL_NEWS_DIR or JSONL_DATA<br>
+# seed: None takes the first rows articles, otherwise a random sample of rows articles
+# 
+# __Output__:<br>
+# Number of stored articles<br>
+
+# In[ ]:
+
+
+def parse_and_store(rows, PATH, workers = NUM_WORKERS, seed = SAMPLE_SEED):
+    if(PATH == ALL_NEWS_DIR):
+        return stream_all_news(True, rows, workers, seed)
+    elif(PATH == JSONL_DATA):
+        nr = sample_name(rows, seed)
+        path = 'pickles/json_news_'+nr+'.corpus'
+        append, skip = resume_point(path, PATH)
+        chunks, progress = ingest_records(read_jsonl(PATH, rows, seed=seed), workers, 'pickles/json_news_'+nr+'.dedup.jsonl', skip)
+        count = store_corpus(chunks, path, append=append, source=PATH, progress=progress)
+        print_stage_summary()
+        return count
+
+
+# __Description__:<br>
+# This method adds the articles of a new csv (with 'title' and 'content' columns) or jsonl file to an existing corpus. Only the new articles are tokenized and they are stored as new shards, recorded with the file name in the corpus index. A file that was already added is skipped. vocabulary-embedding then only counts and encodes the new shards.<br>
+# __Input__ :<br>
+# >fname: Path of the csv or jsonl file, possibly compressed<br>
+# corpus_path: Directory of the corpus, e.g. pickles/all-the-news_all.corpus
+# 
+# __Output__:<br>
+# Number of added articles<br>
+
+# In[ ]:
+
+
+def read_csv_records(fname, chunksize = CHUNK_SIZE):
+    with open_input(fname) as f, pd.read_csv(f, usecols=['title','content'], chunksize=chunksize, keep_default_na=False) as reader:
+        for df in reader:
+            yield from zip(df['title'], df['content'])
+
+def append_news(fname, corpus_path, workers = NUM_WORKERS):
+    source = os.path.basename(fname)
+    resume, skip = resume_point(corpus_path, source)
+    if(not resume and source in news_corpus.corpus_sources(corpus_path)):
+        print(source, 'is already in', corpus_path)
+        return 0
+    records = read_jsonl(fname) if is_jsonl(fname) else read_csv_records(fname)
+    chunks, progress = ingest_records(records, workers, skip=skip)
+    count = store_corpus(chunks, corpus_path, append=True, source=source, progress=progress)
+    print_stage_summary()
+    return count
 
 
-df3 = get_all_news_df(True, NUM_ROWS_EXTRACT)
+# __Description__:<br>
+# These methods build the vocabulary and the id encoded headlines (Y) and descriptions (X) of vocabulary-embedding while the articles are tokenized, without storing the tokenized text. Words get a provisional id when first seen and are counted. At the end the words are sorted like vocabulary-embedding.get_vocab does (by count, ties in order of first appearance in the headlines and then in the descriptions), ids are assigned from start_idx = 2 (0 is <empty>, 1 is <eos>) and the provisional ids are remapped. Like vocabulary-embedding, a headline is the first sentence of the title and a description the lower cased first N_SENTENCES sentences of the content.<br>
+# The result is stored as pickles/<name>_<rows>.ids.pickle, which vocabulary-embedding loads instead of the corpus.<br>
+# __Input__ :<br>
+# >chunks: Iterable of lists of tokenized (title, content) tuples<br>
+# PATH: ALL_NEWS_DIR or JSONL_DATA<br>
+# rows: Number of rows to be processed (None for all)<br>
+# seed: None takes the first rows articles, otherwise a random sample of rows articles
+# 
+# __Output__:<br>
+# encode_articles returns a dictionary with vocab, vocabcount, X and Y, encode_news returns the number of encoded articles<br>
+
+# In[ ]:
+
+
+def encode_articles(chunks, n_sentences = N_SENTENCES, start_idx = 2):
+    pids = {}
+    counts, first_head, first_desc = [], [], []
+    X, Y = [], []
+    head_pos = desc_pos = 0
+    def encode(words, first, pos):
+        ids = []
+        for w in words:
+            p = pids.get(w)
+            if(p is None):
+                p = pids[w] = len(counts)
+                counts.append(0)
+                first_head.append(-1)
+                first_desc.append(-1)
+            counts[p] += 1
+            if(first[p] < 0):
+                first[p] = pos
+            pos += 1
+            ids.append(p)
+        return np.array(ids, dtype=np.int32), pos
+    for chunk in chunks:
+        with stage('encode'):
+            for title, content in chunk:
+                if(len(title) < 1):
+                    continue
+                y, head_pos = encode(title[0].split(), first_head, head_pos)
+                x, desc_pos = encode(' '.join(content[:n_sentences]).lower().split(), first_desc, desc_pos)
+                Y.append(y)
+                X.append(x)
+        count_stage('encode', articles=len(chunk))
+    with stage('encode'):
+        counts, first_head, first_desc = np.array(counts), np.array(first_head), np.array(first_desc)
+        in_desc_only = first_head < 0
+        order = np.lexsort((np.where(in_desc_only, first_desc, first_head), in_desc_only, -counts))
+        remap = np.empty(len(order), dtype=np.int64)
+        remap[order] = np.arange(len(order)) + start_idx
+        words = list(pids)
+        vocab = [words[p] for p in order]
+        vocabcount = Counter(dict(zip(words, counts.tolist())))
+        X = [remap[x].tolist() for x in X]
+        Y = [remap[y].tolist() for y in Y]
+    return dict(vocab=vocab, vocabcount=vocabcount, X=X, Y=Y)
+
+def encode_news(PATH, rows = None, workers = NUM_WORKERS, seed = SAMPLE_SEED):
+    nr = sample_name(rows, seed) if rows is not None else 'all'
+    if(PATH == JSONL_DATA):
+        name = 'pickles/json_news_'+nr
+        records = read_jsonl(PATH, rows, seed=seed)
+    else:
+        name = 'pickles/all-the-news_'+nr
+        records = read_all_news_records(rows, seed=seed)
+    chunks, progress = ingest_records(records, workers, name+'.dedup.jsonl')
+    data = encode_articles(chunks)
+    with stage('store'):
+        with open(name+'.ids.pickle', 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+    count_stage('store', articles=len(data['X']))
+    print('Encoded', len(data['X']), 'rows with', len(data['vocab']), 'words into ', name+'.ids.pickle')
+    print_stage_summary()
+    return len(data['X'])
+
+
+# __Description__:<br>
+# These methods spread ingestion over several processes and machines through a directory that all of them can see (e.g. on NFS). plan_work_units splits the input files into work units (byte ranges of uncompressed jsonl files; csv and compressed jsonl files are cut into plain files of unit_rows rows in queue_dir/split while planning, so no worker has to read past the rows of other units) and writes one json file per unit into queue_dir/todo. Any number of processes, started with python load_data.py --queue-worker queue_dir on any host, claim units by renaming them into queue_dir/claimed (a rename succeeds for exactly one process), tokenize them into queue_dir/out/<unit>.corpus and move them to queue_dir/done. Units claimed by a worker that died can be put back with requeue_stale. merge_work_units moves the shards of all units, in unit order, into the final corpus. Near duplicates are only dropped within a unit.<br>
+# __Input__ :<br>
+# >paths: Input files<br>
+# queue_dir: Shared queue directory<br>
+# corpus_path: Directory of the merged corpus<br>
+# processes: Number of local worker processes (run_local_queue)
+# 
+# __Output__:<br>
+# plan_work_units returns the number of units, merge_work_units and run_local_queue the number of merged articles<br>
+
+# In[ ]:
+
+
+QUEUE_DIRS = ['todo', 'claimed', 'done', 'out', 'split']
+
+def split_rows(path, split_dir, unit_rows = UNIT_ROWS):
+    name = os.path.basename(path)
+    files = []
+    if(is_jsonl(path)):
+        with open_input(path) as f:
+            while True:
+                lines = list(islice(f, unit_rows))
+                if(not lines):
+                    break
+                files.append(os.path.join(split_dir, '%s-%06d.jsonl' % (name, len(files))))
+                with open(files[-1], 'w', encoding='utf-8') as out:
+                    out.writelines(lines)
+        return files
+    with open_input(path) as f, pd.read_csv(f, usecols=['title','content'], chunksize=unit_rows, keep_default_na=False) as reader:
+        for df in reader:
+            files.append(os.path.join(split_dir, '%s-%06d.csv' % (name, len(files))))
+            df.to_csv(files[-1], index=False)
+    return files
+
+def plan_work_units(paths, queue_dir, unit_bytes = UNIT_BYTES, unit_rows = UNIT_ROWS):
+    for d in QUEUE_DIRS:
+        os.makedirs(os.path.join(queue_dir, d), exist_ok=True)
+    units = []
+    for path in paths:
+        path = os.path.abspath(os.path.expanduser(path))
+        if(path.endswith('.jsonl') and os.path.exists(path)):
+            size = os.path.getsize(path)
+            units += [dict(path=path, kind='bytes', start=i, end=min(i+unit_bytes, size)) for i in range(0, size, unit_bytes)]
+        else:
+            # csv and compressed jsonl cannot be entered in the middle, so they are cut into plain unit files in one pass
+            units += [dict(path=f, kind='file', source=path) for f in split_rows(path, os.path.join(queue_dir, 'split'), unit_rows)]
+    for k, unit in enumerate(units):
+        unit['id'] = 'unit-%06d' % k
+        with open(os.path.join(queue_dir, 'todo', unit['id']+'.json'), 'w') as f:
+            json.dump(unit, f)
+    print('Planned', len(units), 'work units in', queue_dir)
+    return len(units)
 
+def read_unit(unit, max_words = MAX_CONTENT_WORDS):
+    path, start, end = unit['path'], unit.get('start'), unit.get('end')
+    if(unit['kind'] == 'bytes'):
+        with open(path, 'rb') as f:
+            if(start > 0):
+                f.seek(start-1)
+                f.readline() # the line containing byte start-1 belongs to the previous unit
+            while f.tell() < end:
+                line = f.readline()
+                if(not line):
+                    break
+                yield parse_jsonl_line(line.decode('utf-8'), max_words)
+    elif(is_jsonl(path)):
+        yield from read_jsonl(path, max_words=max_words)
+    else:
+        yield from read_csv_records(path)
 
-# In[30]:
+def claim_unit(queue_dir):
+    for name in sorted(os.listdir(os.path.join(queue_dir, 'todo'))):
+        claimed = os.path.join(queue_dir, 'claimed', name)
+        try:
+            os.rename(os.path.join(queue_dir, 'todo', name), claimed)
+        except OSError:
+            continue # another worker was faster
+        os.utime(claimed)
+        with open(claimed) as f:
+            return json.load(f)
+    return None
+
+def queue_worker(queue_dir, workers = 1):
+    me = '%s-%d' % (socket.gethostname(), os.getpid())
+    done = 0
+    while True:
+        unit = claim_unit(queue_dir)
+        if(unit is None):
+            break
+        print(me, 'working on', unit['id'])
+        out = os.path.join(queue_dir, 'out', unit['id']+'.corpus')
+        tmp = out+'.'+me
+        shutil.rmtree(tmp, ignore_errors=True)
+        chunks, progress = ingest_records(read_unit(unit), workers, os.path.join(queue_dir, 'out', unit['id']+'.dedup.jsonl'))
+        store_corpus(chunks, tmp, source=os.path.basename(unit.get('source', unit['path'])))
+        if(os.path.exists(out)): # the unit was requeued and finished twice
+            shutil.rmtree(tmp)
+        else:
+            os.rename(tmp, out)
+        os.rename(os.path.join(queue_dir, 'claimed', unit['id']+'.json'), os.path.join(queue_dir, 'done', unit['id']+'.json'))
+        done += 1
+    print(me, 'finished', done, 'work units')
+    return done
+
+def requeue_stale(queue_dir, max_age = 3600):
+    for name in os.listdir(os.path.join(queue_dir, 'claimed')):
+        claimed = os.path.join(queue_dir, 'claimed', name)
+        if(time.time()-os.path.getmtime(claimed) > max_age):
+            os.rename(claimed, os.path.join(queue_dir, 'todo', name))
+            print('Requeued', name)
+
+def merge_work_units(queue_dir, corpus_path):
+    left = os.listdir(os.path.join(queue_dir, 'todo')) + os.listdir(os.path.join(queue_dir, 'claimed'))
+    if(left):
+        print(len(left), 'work units are not done yet')
+        return 0
+    units = sorted(name[:-len('.json')] for name in os.listdir(os.path.join(queue_dir, 'done')))
+    count = news_corpus.merge_corpora([os.path.join(queue_dir, 'out', u+'.corpus') for u in units], corpus_path)
+    shutil.rmtree(os.path.join(queue_dir, 'split'), ignore_errors=True)
+    print('Merged', count, 'rows of', len(units), 'work units into ', corpus_path)
+    return count
+
+def run_local_queue(paths, queue_dir, corpus_path, processes = 4):
+    plan_work_units(paths, queue_dir)
+    procs = [multiprocessing.Process(target=queue_worker, args=(queue_dir,)) for _ in range(processes)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    return merge_work_units(queue_dir, corpus_path)
+
+
+# In[29]:
 
 
-df3.head()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queue-worker', metavar='QUEUE_DIR', help='claim and tokenize work units of a shared queue directory')
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS, help='tokenizer processes per queue worker')
+    args = parser.parse_args()
+    if(args.queue_worker):
+        queue_worker(args.queue_worker, args.workers)
+    else:
+        df3 = get_all_news_df(True, NUM_ROWS_EXTRACT)
+        print_word_memo_stats()
+        df3.head()
 
@@ -0,0 +1,222 @@
+# Sharded on-disk format for tokenized news corpora.
+#
+# A corpus is a directory with an index.json and, for every shard, three .npy files
+# that can be memory-mapped:
+#   <shard>.text.npy      uint8, the utf-8 bytes of all sentences of the shard back to back
+#   <shard>.sents.npy     int64, byte offset of every sentence (one extra entry at the end)
+#   <shard>.articles.npy  int64 (articles+1, 2), sentence offsets of the head and desc of every article
+# The head of article i are sentences articles[i,0]:articles[i,1] and its desc are
+# sentences articles[i,1]:articles[i+1,0].
+# Shards can also be written compressed (<shard>.text.npy.gz and so on). Compressed shards
+# take less disk space but are decompressed into memory when first used instead of being
+# memory-mapped.
+#
+# The index doubles as a manifest: new articles are appended as new shards, each shard
+# records the source it came from and when it was added, and the corpus id changes only
+# when the corpus is rewritten, so later stages can process just the shards they have not
+# seen yet.
+
+from __future__ import print_function
+import bisect
+import bz2
+import gzip
+import io
+import json
+import lzma
+import os
+import time
+import uuid
+import numpy as np
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+INDEX_FILE = 'index.json'
+COMPRESSIONS = ('gz', 'bz2', 'xz', 'zst')
+SHARD_FILES = ('text', 'sents', 'articles')
+
+def open_compressed(path, mode='rb'):
+    """Open a file for binary reading or writing, (de)compressing it as a stream by its extension."""
+    ext = path.rsplit('.', 1)[-1]
+    if ext == 'gz':
+        return gzip.open(path, mode)
+    if ext == 'bz2':
+        return bz2.open(path, mode)
+    if ext == 'xz':
+        return lzma.open(path, mode)
+    if ext == 'zst':
+        if zstandard is None:
+            raise ImportError('zstandard is needed for ' + path + ', install it with pip install zstandard')
+        if 'r' in mode:
+            return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+    return open(path, mode)
+
+def shard_file(path, name, part, compress=None):
+    fname = os.path.join(path, '%s.%s.npy' % (name, part))
+    return fname + '.' + compress if compress else fname
+
+def read_index(path):
+    index_file = os.path.join(path, INDEX_FILE)
+    if not os.path.exists(index_file):
+        return {'shards': []}
+    with open(index_file) as f:
+        return json.load(f)
+
+def write_index(path, index):
+    tmp = os.path.join(path, INDEX_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp, os.path.join(path, INDEX_FILE))
+
+def write_shard(path, name, heads, desc, compress=None):
+    """Write lists of head and desc sentence lists as shard `name` of the corpus at path."""
+    sents, articles = [], []
+    for h, d in zip(heads, desc):
+        articles.append((len(sents), len(sents) + len(h)))
+        sents.extend(h)
+        sents.extend(d)
+    articles.append((len(sents), len(sents)))
+    encoded = [s.encode('utf-8') for s in sents]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+    text = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    arrays = (text, offsets, np.array(articles, dtype=np.int64))
+    for part, arr in zip(SHARD_FILES, arrays):
+        with open_compressed(shard_file(path, name, part, compress), 'wb') as f:
+            np.save(f, arr)
+    return {'name': name, 'articles': len(heads), 'sentences': len(sents), 'bytes': int(offsets[-1]),
+            'compress': compress}
+
+def write_corpus(path, chunks, shard_size=10000, append=False, source=None, checkpoint=None, compress=None):
+    """Write an iterable of (heads, desc) chunks as shards of about shard_size articles.
+
+    With append=True the shards are added after the shards already listed in the index,
+    otherwise the corpus is started from scratch. Shards are cut at chunk boundaries and
+    the index is rewritten after every shard, so a crash only loses the shard in progress;
+    checkpoint() is called after each shard and its value (the input position the shard
+    goes up to) is stored as the shard's input_rows. The index is marked complete at the end.
+    compress is one of COMPRESSIONS to write compressed shards, or None.
+    Returns the number of articles written.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    index = read_index(path) if append else {'shards': []}
+    if 'id' not in index:
+        index['id'] = uuid.uuid4().hex
+    index['complete'] = False
+    first = len(index['shards'])
+
+    def add_shard(heads, desc):
+        name = 'shard-%05d' % len(index['shards'])
+        shard = write_shard(path, name, heads, desc, compress)
+        shard.update(source=source, added=time.strftime('%Y-%m-%d %H:%M:%S'))
+        if checkpoint is not None:
+            shard['input_rows'] = checkpoint()
+        index['shards'].append(shard)
+        write_index(path, index)
+
+    heads, desc = [], []
+    for h, d in chunks:
+        heads.extend(h)
+        desc.extend(d)
+        if len(heads) >= shard_size:
+            add_shard(heads, desc)
+            heads, desc = [], []
+    if heads or not index['shards']:
+        add_shard(heads, desc)
+    index['complete'] = True
+    write_index(path, index)
+    return sum(s['articles'] for s in index['shards'][first:])
+
+def merge_corpora(paths, path):
+    """Move the shards of the corpora at paths, in that order, into a new corpus at path."""
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    index = {'id': uuid.uuid4().hex, 'shards': [], 'complete': False}
+    for src in paths:
+        for shard in read_index(src)['shards']:
+            name = 'shard-%05d' % len(index['shards'])
+            for part in SHARD_FILES:
+                os.replace(shard_file(src, shard['name'], part, shard.get('compress')),
+                           shard_file(path, name, part, shard.get('compress')))
+            shard.update(name=name, merged_from=os.path.basename(src))
+            index['shards'].append(shard)
+    index['complete'] = True
+    write_index(path, index)
+    return sum(s['articles'] for s in index['shards'])
+
+def corpus_sources(path):
+    """Sources of all shards of the corpus at path."""
+    return set(s.get('source') for s in read_index(path)['shards'])
+
+
+class NewsCorpus(object):
+    """Random access reader for a sharded corpus. Shards are memory-mapped when first used."""
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        self.mmap_mode = mmap_mode
+        self.index = read_index(path)
+        self.starts = [0]
+        for shard in self.index['shards']:
+            self.starts.append(self.starts[-1] + shard['articles'])
+        self.loaded = {}
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def shard_names(self):
+        return [s['name'] for s in self.index['shards']]
+
+    def shard_articles(self, k):
+        """Indices of the articles stored in shard k."""
+        return range(self.starts[k], self.starts[k+1])
+
+    def shard(self, k):
+        if k not in self.loaded:
+            info = self.index['shards'][k]
+            compress = info.get('compress')
+            arrays = []
+            for part in SHARD_FILES:
+                fname = shard_file(self.path, info['name'], part, compress)
+                if compress:
+                    with open_compressed(fname, 'rb') as f:
+                        arrays.append(np.load(io.BytesIO(f.read())))
+                else:
+                    arrays.append(np.load(fname, mmap_mode=self.mmap_mode))
+            self.loaded[k] = tuple(arrays)
+        return self.loaded[k]
+
+    def locate(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('article index out of range')
+        k = bisect.bisect_right(self.starts, i) - 1
+        return k, i - self.starts[k]
+
+    def sentences(self, k, start, stop):
+        text, offsets, _ = self.shard(k)
+        return [bytes(text[offsets[j]:offsets[j+1]]).decode('utf-8') for j in range(start, stop)]
+
+    def head(self, i):
+        k, j = self.locate(i)
+        articles = self.shard(k)[2]
+        return self.sentences(k, articles[j, 0], articles[j, 1])
+
+    def desc(self, i, max_sentences=None):
+        k, j = self.locate(i)
+        articles = self.shard(k)[2]
+        start, stop = articles[j, 1], articles[j+1, 0]
+        if max_sentences is not None:
+            stop = min(stop, start + max_sentences)
+        return self.sentences(k, start, stop)
+
+    def __getitem__(self, i):
+        return self.head(i), self.desc(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
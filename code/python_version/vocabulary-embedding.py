@@ -40,19 +40,61 @@ lower = True # whether to lowercase the text
 
 
 # # Read tokenized headlines and descriptions
+# Only the first `n_sentences` sentences of every description are used.
+# 
+# If load_data stored a sharded corpus (`pickles/<FN0>_<FN_lines>.corpus`) only those sentences are read from it, otherwise the whole pickle is loaded.
+# 
+# With a corpus the vocabulary counts and the encoded `X`/`Y` are kept in `vocab_state_file`, so after `load_data.append_news` only the new shards are read, counted and encoded. The merged counts are sorted again like `get_vocab` does, so a word first seen in a new shard gets the rank its total count deserves, and the stored `X`/`Y` are mapped to the new ids with one lookup array.
+# 
+# If `load_data.encode_news` already built the vocabulary and `X`/`Y` while tokenizing (`pickles/<FN0>_<FN_lines>.ids.pickle`), they are loaded from there and no text is read at all, unless the corpus or the pickle was written after them.
 
-# In[431]:
+# In[432]:
 
 
-import pickle
-with open('pickles/%s_%s.pickle'%(FN0, FN_lines), 'rb') as fp:
-    heads, desc, keywords = pickle.load(fp) # keywords are not used in this project
+n_sentences = 5
 
 
-# In[432]:
+# In[431]:
 
 
-n_sentences = 5
+import os
+import pickle
+import numpy as np
+from collections import Counter
+from news_corpus import NewsCorpus
+corpus_path = 'pickles/%s_%s.corpus'%(FN0, FN_lines)
+fused_file = 'pickles/%s_%s.ids.pickle'%(FN0, FN_lines)
+vocab_state_file = 'data/%s-%s-vocab-state.pickle'%(FN0, FN_lines)
+pickle_file = 'pickles/%s_%s.pickle'%(FN0, FN_lines)
+# the ids are only used if neither the corpus nor the pickle was written after them
+sources = [f for f in [os.path.join(corpus_path, 'index.json'), pickle_file] if os.path.exists(f)]
+fused = os.path.exists(fused_file) and all(os.path.getmtime(fused_file) >= os.path.getmtime(f) for f in sources)
+if os.path.exists(fused_file) and not fused:
+    print('Ignoring', fused_file, 'because it is older than', ' and '.join(sources))
+incremental = not fused and os.path.isdir(corpus_path)
+state = {'corpus': None, 'shards': [], 'vocab': [], 'vocabcount': Counter(), 'X': [], 'Y': []}
+if fused:
+    with open(fused_file, 'rb') as fp:
+        fused_data = pickle.load(fp)
+    heads, desc, keywords = [], [], None
+elif incremental:
+    corpus = NewsCorpus(corpus_path)
+    if os.path.exists(vocab_state_file):
+        with open(vocab_state_file, 'rb') as fp:
+            saved = pickle.load(fp)
+        if saved['corpus'] == corpus.index['id']: # the corpus was not rewritten since
+            state = saved
+    state['corpus'] = corpus.index['id']
+    new_shards = [k for k, name in enumerate(corpus.shard_names()) if name not in state['shards']]
+    articles = [i for k in new_shards for i in corpus.shard_articles(k)]
+    print('Reading', len(articles), 'new articles from', len(new_shards), 'new shards')
+    heads = [corpus.head(i) for i in articles]
+    desc = [corpus.desc(i, n_sentences) for i in articles]
+    keywords = None
+    state['shards'] += [corpus.shard_names()[k] for k in new_shards]
+else:
+    with open(pickle_file, 'rb') as fp:
+        heads, desc, keywords = pickle.load(fp) # keywords are not used in this project
 
 
 # In[433]:
@@ -73,13 +115,13 @@ if lower:
 
 
 i=0
-heads[i]
+heads[i] if heads else None
 
 
 # In[436]:
 
 
-desc[i]
+desc[i] if desc else None
 
 
 # In[437]:
@@ -117,6 +159,12 @@ def get_vocab(lst):
 
 
 vocab, vocabcount = get_vocab(heads+desc)
+if fused:
+    vocab, vocabcount = fused_data['vocab'], fused_data['vocabcount']
+if state['vocab']:
+    # rank the words of earlier and new shards together, the stored X/Y are remapped below
+    vocabcount = state['vocabcount'] + vocabcount
+    vocab = list(map(lambda x: x[0], sorted(vocabcount.items(), key=lambda x: -x[1])))
 
 
 # In[442]:
@@ -171,6 +219,15 @@ def get_idx(vocab, vocabcount):
 word2idx, idx2word = get_idx(vocab, vocabcount)
 
 
+# In[ ]:
+
+
+# old id -> new id of the words encoded in earlier runs (ids start at start_idx, in the order of state['vocab'])
+old2new = np.array([empty, eos] + [word2idx[w] for w in state['vocab']], dtype=np.int64)
+state['X'] = [old2new[x].tolist() for x in state['X']]
+state['Y'] = [old2new[y].tolist() for y in state['Y']]
+
+
 # # Word Embedding
 
 # ## Read GloVe
@@ -388,8 +445,10 @@ glove_idx2idx = dict((word2idx[w],embedding_idx) for  w, embedding_idx, _ in glo
 #  heads[0].split() == ['New', 'York', 'Time']
 #  Y[0] == [1065, 1424, 5309]
 #  word2idx['New'] == 1065
-# len(Y) should match len(heads)
-Y = [[word2idx[token] for token in headline.split()] for headline in heads]
+# len(Y) should match len(heads) plus the headlines encoded in earlier runs
+Y = state['Y'] + [[word2idx[token] for token in headline.split()] for headline in heads]
+if fused:
+    Y = fused_data['Y']
 len(Y)
 
 
@@ -410,8 +469,10 @@ plt.ylabel('Total occurrences')
 #  desc[0].split() == ['New', 'York', 'Time']
 #  X[0] == [1065, 1424, 5309]
 #  word2idx['New'] == 1065
-# len(X) should match len(desc)
-X = [[word2idx[token] for token in d.split()] for d in desc]
+# len(X) should match len(desc) plus the descriptions encoded in earlier runs
+X = state['X'] + [[word2idx[token] for token in d.split()] for d in desc]
+if fused:
+    X = fused_data['X']
 len(X)
 
 
@@ -438,6 +499,15 @@ with open('data/%s-%s-vocab-embedding-elmo-10000.data.pickle'%(FN0, FN_lines),'w
     pickle.dump((X,Y),fp,-1)
 
 
+# In[ ]:
+
+
+if incremental:
+    state.update(vocab=vocab, vocabcount=vocabcount, X=X, Y=Y)
+    with open(vocab_state_file,'wb') as fp:
+        pickle.dump(state,fp,-1)
+
+
 # In[465]:
 
 